@@ -17,9 +17,14 @@ class Config(AbstractConfig):
     config = dict(
         daemon=dict(
             pid=os.getcwd() + '/amplify_agent.pid',
+            tail_checkpoints=None,  # amplify_agent.tails next to the pid file, see TailCheckpoints
         ),
         containers=dict(
         ),
+        statsd=dict(
+            percentiles='95',  # for every timer, "percentiles.<metric name>" sets them for one timer
+            histograms='',  # timers that also report numbers of values in LogLinearHistogram buckets
+        ),
         cloud=dict(
             talk_interval=120.0,
             push_interval=20.0,
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
-
 from amplify.agent import CommonDataTank, CommonDataClient
 
 
@@ -34,8 +32,8 @@ class ConfigdClient(CommonDataClient):
         if not self.current:
             return
 
-        delivery = copy.deepcopy(self.current)
-        self.current = {}
+        # the config is handed over as is, collectors build a new payload every time, so nothing is copied
+        delivery, self.current = self.current, {}
         return {
             'object': self.object.definition,
             'config': delivery,
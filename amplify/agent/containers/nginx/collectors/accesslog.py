@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
-from amplify.agent.containers.nginx.log.access import NginxAccessLogParser
+import math
+import time
+import weakref
+
+from amplify.agent.containers.nginx.log.access import parser_cache
 from amplify.agent.util.tail import FileTail
+from amplify.agent.util.inotify import FileWatcher
 from amplify.agent.context import context
+from amplify.agent.eventd import INFO, WARNING
 from amplify.agent.containers.abstract import AbstractCollector
 
 __author__ = "Mike Belov"
@@ -12,6 +18,11 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+# filename, bytes behind EOF, lines per second and bytes skipped by catch-up since the last report
+# of every running access log collector, reported as agent metrics by the system container
+log_stats = weakref.WeakKeyDictionary()
+
+
 class NginxAccessLogsCollector(AbstractCollector):
 
     short_name = 'nginx_alog'
@@ -54,6 +65,22 @@ class NginxAccessLogsCollector(AbstractCollector):
         # 'upstream.request.count': None  # Not sure how to handle for same reason above.
     }
 
+    # variables consumed by the handlers, the parser doesn't capture and convert other ones
+    # any $upstream_* variable tells upstreams() that the request was proxied
+    parsed_variables = (
+        'request',
+        'status',
+        'body_bytes_sent',
+        'bytes_sent',
+        'request_length',
+        'gzip_ratio',
+        'request_time',
+        'upstream_*',
+    )
+
+    # adaptive sampling: if more lines per second than this are expected, only every Nth line is parsed
+    sampling_threshold = 10000
+
     valid_http_methods = (
         'head',
         'get',
@@ -63,60 +90,357 @@ class NginxAccessLogsCollector(AbstractCollector):
         'options'
     )
 
-    def __init__(self, filename=None, log_format=None, tail=None, **kwargs):
+    def __init__(self, filename=None, log_format=None, tail=None, sampling=False, time_budget=None, line_budget=None,
+                 resume_max_bytes=None, catchup_policy=None, catchup_threshold=None, gzip=False, lazy_tail=False,
+                 **kwargs):
         super(NginxAccessLogsCollector, self).__init__(**kwargs)
         self.filename = filename
-        self.parser = NginxAccessLogParser(log_format)
-        self.tail = tail if tail is not None else FileTail(filename)
+        self.parser = parser_cache.get(log_format, fields=self.parsed_variables)
+        self.tail = tail if tail is not None else FileTail(
+            filename, resume_max_bytes=resume_max_bytes, gzip=gzip, lazy=lazy_tail
+        )
+
+        # wakes the collector when the file changes instead of every interval, see _sleep()
+        # it is created on the first sleep, collectors driven by TailEngine never sleep
+        self.watcher = None
+        self.changed = True
+        self.missing = False
+
+        # a pass stops after the first chunk that exhausts one of budgets, the rest is read in the next pass
+        self.time_budget = time_budget
+        self.line_budget = line_budget
+
+        # if more than catchup_threshold bytes are unread, the log is either skipped to the end ("skip")
+        # or read as usual in blocks ("read"), a pass at a time within the budgets, see chunks()
+        self.catchup_policy = catchup_policy
+        self.catchup_threshold = catchup_threshold
+        self.skipped_bytes = 0
+
+        # adaptive sampling state, see get_sampling_step()
+        self.sampling = sampling
+        self.sampling_step = 1
+        self.previous_pass = None  # time when the previous pass started
+        self.line_rate = 0.0  # lines per second written to the log, as seen by the previous pass
+        self.bytes_per_line = 0
+
+        # metrics are aggregated in slots during collect() and handed to statsd at once, see flush_metrics()
+        # a counter slot holds a sum (None if it was not touched), a sample slot holds a list of timer/average values
+        self.counter_names, self.counter_values, self.counter_slots = [], [], {}
+        self.sample_names, self.sample_values, self.sample_slots = [], [], {}
+
+        for counter in self.counters:
+            self.counter_slot(counter)
+
+        self.method_slots = dict(
+            (method, self.counter_slot('http.method.%s' % method)) for method in self.valid_http_methods
+        )
+        self.other_method_slot = self.counter_slot('http.method.other')
+        self.status_slots = dict((str(i), self.counter_slot('http.status.%sxx' % i)) for i in xrange(1, 6))
+        self.discarded_status_slot = self.counter_slot('http.status.discarded')
+        self.version_slots = dict(
+            (version, self.counter_slot('http.v%s' % suffix))
+            for version, suffix in (('0.9', '0_9'), ('1.0', '1_0'), ('1.1', '1_1'), ('2.0', '2'))
+        )
+        self.malformed_slot = self.counter_slot('http.request.malformed')
+        self.request_length_slot = self.counter_slot('http.request.length')
+        self.body_bytes_sent_slot = self.counter_slot('http.request.body_bytes_sent')
+        self.bytes_sent_slot = self.counter_slot('http.request.bytes_sent')
+        self.upstream_status_slots = dict(
+            (str(i), self.counter_slot('upstream.http.status.%sxx' % i)) for i in xrange(1, 6)
+        )
+        self.upstream_length_slot = self.counter_slot('upstream.http.response.length')
+        self.upstream_next_slot = self.counter_slot('upstream.next.count')
+        self.upstream_request_slot = self.counter_slot('upstream.request.count')
+        self.cache_slots = dict(
+            (counter[6:], slot) for counter, slot in self.counter_slots.iteritems() if counter.startswith('cache.')
+        )
+
+        self.gzip_ratio_slot = self.sample_slot('average', 'http.gzip.ratio')
+        self.request_time_slot = self.sample_slot('timer', 'http.request.time')
+        self.upstream_time_slots = [
+            (key_name, self.sample_slot('timer', metric_name)) for metric_name, key_name in (
+                ('upstream.connect.time', 'upstream_connect_time'),
+                ('upstream.response.time', 'upstream_response_time'),
+                ('upstream.header.time', 'upstream_header_time')
+            )
+        ]
+
+        # slots above are permanent, slots for unexpected values live until the next flush
+        self.static_counter_slots = len(self.counter_names)
+
+    def counter_slot(self, name):
+        """
+        Returns a slot of the counter, creates it if needed
+
+        :param name: metric name
+        :return: int slot
+        """
+        slot = self.counter_slots.get(name)
+        if slot is None:
+            slot = self.counter_slots[name] = len(self.counter_names)
+            self.counter_names.append(name)
+            self.counter_values.append(None)
+        return slot
+
+    def sample_slot(self, metric_type, name):
+        """
+        Returns a slot of the timer or average metric, creates it if needed
+
+        :param metric_type: str "timer" or "average"
+        :param name: metric name
+        :return: int slot
+        """
+        slot = self.sample_slots.get((metric_type, name))
+        if slot is None:
+            slot = self.sample_slots[(metric_type, name)] = len(self.sample_names)
+            self.sample_names.append((metric_type, name))
+            self.sample_values.append([])
+        return slot
+
+    def count(self, slot, value=1):
+        """
+        Adds value to the counter slot
+
+        :param slot: int slot
+        :param value: value to add
+        """
+        current = self.counter_values[slot]
+        self.counter_values[slot] = value if current is None else current + value
+
+    def flush_metrics(self):
+        """
+        Hands all aggregated metrics to statsd in one bulk call and resets slots
+        Counters are scaled back up if only a part of lines was parsed, samples are left as they are
+        """
+        step = self.sampling_step
+        counters = [
+            (name, value * step) for name, value in zip(self.counter_names, self.counter_values) if value is not None
+        ]
+        timers, averages = [], []
+        for (metric_type, name), values in zip(self.sample_names, self.sample_values):
+            if values:
+                (timers if metric_type == 'timer' else averages).append((name, values))
+
+        self.statsd.bulk(counters=counters, timers=timers, averages=averages)
+
+        # drop slots of unexpected values
+        for name in self.counter_names[self.static_counter_slots:]:
+            del self.counter_slots[name]
+        del self.counter_names[self.static_counter_slots:]
+
+        self.counter_values = [None] * len(self.counter_names)
+        self.sample_values = [[] for _ in self.sample_names]
 
     def init_counters(self):
         for counter, key in self.counters.iteritems():
             # If keys are in the parser format (access log) or not defined (error log)
             if key in self.parser.keys:
-                self.statsd.incr(counter, value=0)
+                self.count(self.counter_slots[counter], 0)
+
+    def pass_period(self, now):
+        """
+        Returns wall-clock time since the previous pass started
+        Passes are not always interval apart: the watcher starts one shortly after the log changes,
+        and TailEngine runs all its collectors at the shortest interval of them
+
+        :param now: float time when the current pass starts
+        :return: float seconds, interval before the first pass
+        """
+        if self.previous_pass is None:
+            return float(self.interval or 1)
+        return max(now - self.previous_pass, 0.001)
+
+    def get_sampling_step(self, now):
+        """
+        Decides which part of lines should be parsed in this pass
+
+        Expected rate is the max of lines per second seen by the previous pass and the unread part of the file
+        spread over the time since the previous pass. If it's above the threshold - every Nth line is parsed,
+        so that about the threshold number of lines per second is left.
+        N stays the same for the whole pass, so timer samples are picked evenly from all the lines.
+
+        :param now: float time when the pass starts
+        :return: int N
+        """
+        if not self.sampling:
+            return 1
+
+        expected_rate = self.line_rate
+        if isinstance(self.tail, FileTail) and self.bytes_per_line:
+            backlog_lines = float(self.tail.backlog()) / self.bytes_per_line
+            expected_rate = max(expected_rate, backlog_lines / self.pass_period(now))
+
+        if expected_rate <= self.sampling_threshold:
+            return 1
+        return int(math.ceil(expected_rate / self.sampling_threshold))
+
+    def budget_exhausted(self, started, lines):
+        """
+        Checks if the pass should stop reading the log
+
+        :param started: float time when the pass started
+        :param lines: int number of lines read in the pass
+        :return: bool
+        """
+        if self.line_budget and lines >= self.line_budget:
+            return True
+        if self.time_budget and time.time() - started >= self.time_budget:
+            return True
+        return False
+
+    def _sleep(self):
+        if not isinstance(self.tail, FileTail):
+            super(NginxAccessLogsCollector, self)._sleep()
+            return
+
+        if self.watcher is None:
+            # writes made before the watch started would not wake it, so the first sleep is a plain one
+            self.watcher = FileWatcher(self.filename)
+            super(NginxAccessLogsCollector, self)._sleep()
+            return
+
+        if not self.tail.caught_up:
+            # the previous pass left unread lines (budget, rotation), the watcher won't report them again
+            super(NginxAccessLogsCollector, self)._sleep()
+            self.changed = True
+            return
+
+        self.changed = self.watcher.wait(self.interval)
 
     def collect(self):
         self.init_counters()  # set all counters to 0
 
-        count = 0
-        for line in self.tail:
-            count += 1
-            try:
-                parsed = self.parser.parse(line)
-            except:
-                context.log.debug('could parse line %s' % line, exc_info=True)
-                parsed = None
+        if not self.changed:
+            # nothing was written to the log, do not even stat it
+            self.flush_metrics()
+            if self.sampling:
+                self.previous_pass, self.line_rate = time.time(), 0.0
+            lag_bytes = log_stats[self][1] if self in log_stats else 0
+            self.report_stats(lag_bytes, 0.0)
+            return
 
-            if not parsed:
-                continue
+        started = time.time()
+        self.sampling_step = step = self.get_sampling_step(started)
+
+        # backlog of a gzip log is counted in compressed bytes, so bytes per line should be too
+        gzip_tail = isinstance(self.tail, FileTail) and self.tail.gzip
+        bytes_read = self.tail.bytes_read if gzip_tail else 0
+
+        count, size, start = 0, 0, 0
+        chunks = self.chunks()
+        for chunk in chunks:
+            lines = chunk.count('\n')
+            count += lines
+            size += len(chunk)
+
+            parsed_lines = self.parser.parse_chunk(chunk, start, step)
+            start = (start - lines) % step  # keep every Nth line across chunks
+
+            for parsed in parsed_lines:
+                if not parsed:
+                    continue
+
+                if parsed['malformed']:
+                    self.request_malformed()
+                else:
+                    for method in (
+                        self.http_method,
+                        self.http_status,
+                        self.http_version,
+                        self.bytes_sent_rcvd,
+                        self.gzip_ration,
+                        self.request_time,
+                        self.upstreams
+                    ):
+                        try:
+                            method(parsed)
+                        except Exception as e:
+                            exception_name = e.__class__.__name__
+                            context.log.error(
+                                'failed to collect log metrics %s due to %s' % (method.__name__, exception_name))
+                            context.log.debug('additional info:', exc_info=True)
+
+            if self.budget_exhausted(started, count):
+                chunks.close()  # leaves the tail right after this chunk
+                break
 
-            if parsed['malformed']:
-                self.request_malformed()
-            else:
-                for method in (
-                    self.http_method,
-                    self.http_status,
-                    self.http_version,
-                    self.bytes_sent_rcvd,
-                    self.gzip_ration,
-                    self.request_time,
-                    self.upstreams
-                ):
-                    try:
-                        method(parsed)
-                    except Exception as e:
-                        exception_name = e.__class__.__name__
-                        context.log.error(
-                            'failed to collect log metrics %s due to %s' % (method.__name__, exception_name))
-                        context.log.debug('additional info:', exc_info=True)
-
-        context.log.debug('%s processed %s lines from %s' % (self.object.id, count, self.filename))
+        self.flush_metrics()
+
+        if self.sampling:
+            self.line_rate = count / self.pass_period(started)
+            self.previous_pass = started
+            if count:
+                if gzip_tail:
+                    size = self.tail.bytes_read - bytes_read
+                self.bytes_per_line = float(size) / count
+            self.statsd.gauge('http.request.sampling_ratio', 1.0 / step)
+
+        elapsed = time.time() - started
+        lag_bytes = self.tail.backlog() if isinstance(self.tail, FileTail) else 0
+        lines_per_second = count / elapsed if elapsed else 0.0
+        self.report_stats(lag_bytes, lines_per_second)
+
+        context.log.debug(
+            '%s processed %s lines from %s (%.0f lines/s, %s bytes behind)' %
+            (self.object.id, count, self.filename, lines_per_second, lag_bytes)
+        )
+
+        self.check_missing()
+
+    def report_stats(self, lag_bytes, lines_per_second):
+        """
+        Updates log_stats of the collector
+        Skipped bytes are added up until the system container reports and resets them
+
+        :param lag_bytes: int bytes behind EOF
+        :param lines_per_second: float lines read per second in the last pass
+        """
+        unreported = log_stats[self][3] if self in log_stats else 0
+        log_stats[self] = (self.filename, lag_bytes, lines_per_second, unreported + self.skipped_bytes)
+        self.skipped_bytes = 0
+
+    def check_missing(self):
+        """
+        Sends an event when the log file disappears and when it is back
+        """
+        missing = isinstance(self.tail, FileTail) and self.tail.missing_since is not None
+        if missing == self.missing:
+            return
+
+        self.missing = missing
+        if missing:
+            self.eventd.event(level=WARNING, message='nginx log %s is missing' % self.filename)
+        else:
+            self.eventd.event(level=INFO, message='nginx log %s is found again' % self.filename)
+
+    def chunks(self):
+        """
+        Unread log lines grouped into newline terminated chunks
+
+        :return: generator of str
+        """
+        if isinstance(self.tail, FileTail):
+            if self.catchup_policy == 'skip' and self.tail.backlog() > self.catchup_threshold:
+                skipped = self.tail.skip_to_end()
+                self.skipped_bytes += skipped
+                self.eventd.event(
+                    level=WARNING,
+                    message='nginx log %s is too far behind, skipped %s bytes' % (self.filename, skipped)
+                )
+                return
+
+            for chunk in self.tail.readchunks():
+                yield chunk
+        else:
+            lines = list(self.tail)
+            if lines:
+                yield '\n'.join(lines) + '\n'
 
     def request_malformed(self):
         """
         nginx.http.request.malformed
         """
-        self.statsd.incr('http.request.malformed')
+        self.count(self.malformed_slot)
 
     def http_method(self, data):
         """
@@ -129,10 +453,7 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.http.method.other
         """
         if 'http_method' in data:
-            method = data['http_method'].lower()
-            method = method if method in self.valid_http_methods else 'other'
-            metric_name = 'http.method.%s' % method
-            self.statsd.incr(metric_name)
+            self.count(self.method_slots.get(data['http_method'].lower(), self.other_method_slot))
 
     def http_status(self, data):
         """
@@ -145,9 +466,13 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         if 'status' in data:
             status = data['status']
-            suffix = 'discarded' if status in ('499', '444', '408') else '%sxx' % status[0]
-            metric_name = 'http.status.%s' % suffix
-            self.statsd.incr(metric_name)
+            if status in ('499', '444', '408'):
+                slot = self.discarded_status_slot
+            else:
+                slot = self.status_slots.get(status[0])
+                if slot is None:
+                    slot = self.counter_slot('http.status.%sxx' % status[0])
+            self.count(slot)
 
     def http_version(self, data):
         """
@@ -158,19 +483,10 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         if 'http_version' in data:
             version = data['http_version']
-            if version.startswith('0.9'):
-                suffix = '0_9'
-            elif version.startswith('1.0'):
-                suffix = '1_0'
-            elif version.startswith('1.1'):
-                suffix = '1_1'
-            elif version.startswith('2.0'):
-                suffix = '2'
-            else:
-                suffix = version.replace('.', '_')
-
-            metric_name = 'http.v%s' % suffix
-            self.statsd.incr(metric_name)
+            slot = self.version_slots.get(version[:3])
+            if slot is None:
+                slot = self.counter_slot('http.v%s' % version.replace('.', '_'))
+            self.count(slot)
 
     def bytes_sent_rcvd(self, data):
         """
@@ -179,20 +495,20 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.http.request.length
         """
         if 'request_length' in data:
-            self.statsd.incr('http.request.length', data['request_length'])
+            self.count(self.request_length_slot, data['request_length'])
 
         if 'body_bytes_sent' in data:
-            self.statsd.incr('http.request.body_bytes_sent', data['body_bytes_sent'])
+            self.count(self.body_bytes_sent_slot, data['body_bytes_sent'])
 
         if 'bytes_sent' in data:
-            self.statsd.incr('http.request.bytes_sent', data['bytes_sent'])
+            self.count(self.bytes_sent_slot, data['bytes_sent'])
 
     def gzip_ration(self, data):
         """
         nginx.http.gzip.ratio
         """
         if 'gzip_ratio' in data:
-            self.statsd.average('http.gzip.ratio', data['gzip_ratio'])
+            self.sample_values[self.gzip_ratio_slot].append(data['gzip_ratio'])
 
     def request_time(self, data):
         """
@@ -203,7 +519,7 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.http.request.time.count
         """
         if 'request_time' in data:
-            self.statsd.timer('http.request.time', sum(data['request_time']))
+            self.sample_values[self.request_time_slot].append(sum(data['request_time']))
 
     def upstreams(self, data):
         """
@@ -242,8 +558,8 @@ class NginxAccessLogsCollector(AbstractCollector):
         # find out if we have info about upstreams
         empty_values = ('-', '')
         upstream_data_found = False
-        for key in data.iterkeys():
-            if key.startswith('upstream') and data[key] not in empty_values:
+        for key, value in data.iteritems():
+            if key.startswith('upstream') and value not in empty_values:
                 upstream_data_found = True
                 break
 
@@ -254,21 +570,18 @@ class NginxAccessLogsCollector(AbstractCollector):
         upstream_response = False
         if 'upstream_status' in data:
             status = data['upstream_status']
-            suffix = '%sxx' % status[0]
-            metric_name = 'upstream.http.status.%s' % suffix
-            upstream_response = True if suffix in ('2xx', '3xx') else False  # Set flag for upstream length processing
-            self.statsd.incr(metric_name)
+            slot = self.upstream_status_slots.get(status[0])
+            if slot is None:
+                slot = self.counter_slot('upstream.http.status.%sxx' % status[0])
+            upstream_response = status[0] in ('2', '3')  # Set flag for upstream length processing
+            self.count(slot)
 
         if upstream_response and 'upstream_response_length' in data:
-            self.statsd.incr('upstream.http.response.length', data['upstream_response_length'])
+            self.count(self.upstream_length_slot, data['upstream_response_length'])
 
         # gauges
         upstream_switches = None
-        for metric_name, key_name in {
-            'upstream.connect.time': 'upstream_connect_time',
-            'upstream.response.time': 'upstream_response_time',
-            'upstream.header.time': 'upstream_header_time'
-        }.iteritems():
+        for key_name, slot in self.upstream_time_slots:
             if key_name in data:
                 values = data[key_name]
 
@@ -277,17 +590,19 @@ class NginxAccessLogsCollector(AbstractCollector):
                     upstream_switches = len(values) - 1
 
                 # store all values
-                self.statsd.timer(metric_name, sum(values))
+                self.sample_values[slot].append(sum(values))
 
         # log upstream switches
-        self.statsd.incr('upstream.next.count', 0 if upstream_switches is None else upstream_switches)
+        self.count(self.upstream_next_slot, 0 if upstream_switches is None else upstream_switches)
 
         # cache
         if 'upstream_cache_status' in data:
-            cache_status = data['upstream_cache_status']
+            cache_status = data['upstream_cache_status'].lower()
             if not cache_status.startswith('-'):
-                metric_name = 'cache.%s' % cache_status.lower()
-                self.statsd.incr(metric_name)
+                slot = self.cache_slots.get(cache_status)
+                if slot is None:
+                    slot = self.counter_slot('cache.%s' % cache_status)
+                self.count(slot)
 
         # log total upstream requests
-        self.statsd.incr('upstream.request.count')
+        self.count(self.upstream_request_slot)
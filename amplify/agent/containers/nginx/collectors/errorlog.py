@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-from amplify.agent.containers.nginx.log.error import NginxErrorLogParser
+from amplify.agent.containers.nginx.log.error import NginxErrorLogParser, ErrorTemplates, upstream_address
 from amplify.agent.util.tail import FileTail
+from amplify.agent.util.inotify import FileWatcher
 from amplify.agent.context import context
+from amplify.agent.eventd import INFO, WARNING
 from amplify.agent.containers.abstract import AbstractCollector
 from amplify.agent.containers.nginx.config.config import ERROR_LOG_LEVELS
 
@@ -14,6 +16,53 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+class CappedCounters(object):
+    """
+    Counters for names that are not known in advance, like upstream addresses
+
+    Values are kept in a list, a name gets the next slot when it is seen for the first time.
+    Not more than `max_names` names are counted separately, the rest goes to the overflow bucket.
+    A name that was not seen since the last flush gives its slot back.
+    """
+
+    overflow_name = '__other__'
+
+    def __init__(self, max_names=100):
+        self.max_names = max_names
+        self.names = []
+        self.values = []
+        self.slots = {}  # name -> index in names and values
+        self.overflow = 0
+
+    def incr(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            if len(self.names) >= self.max_names:
+                self.overflow += 1
+                return
+
+            slot = self.slots[name] = len(self.names)
+            self.names.append(name)
+            self.values.append(0)
+        self.values[slot] += 1
+
+    def flush(self):
+        """
+        Returns counted values and starts counting from zero
+
+        :return: list of (name, value)
+        """
+        result = [(name, value) for name, value in zip(self.names, self.values) if value]
+        if self.overflow:
+            result.append((self.overflow_name, self.overflow))
+
+        self.names = [name for name, value in result if name != self.overflow_name]
+        self.values = [0] * len(self.names)
+        self.slots = dict((name, slot) for slot, name in enumerate(self.names))
+        self.overflow = 0
+        return result
+
+
 class NginxErrorLogsCollector(AbstractCollector):
 
     short_name = 'nginx_elog'
@@ -25,25 +74,89 @@ class NginxErrorLogsCollector(AbstractCollector):
         'upstream.response.failed',
     )
 
-    def __init__(self, filename=None, level=None, log_format=None, tail=None, **kwargs):
+    failures = (
+        'upstream.request.failed',
+        'upstream.response.failed',
+    )
+
+    serious_levels = ('error', 'crit', 'alert', 'emerg')
+
+    def __init__(self, filename=None, level=None, log_format=None, tail=None, resume_max_bytes=None,
+                 max_failure_names=100, max_templates=100, top_templates=10, min_level='warn', lazy_tail=False,
+                 **kwargs):
         super(NginxErrorLogsCollector, self).__init__(**kwargs)
         self.filename = filename
         self.level = level
         self.parser = NginxErrorLogParser()
-        self.tail = tail if tail is not None else FileTail(filename)
+        self.tail = tail if tail is not None else FileTail(
+            filename, resume_max_bytes=resume_max_bytes, lazy=lazy_tail
+        )
+
+        # wakes the collector when the file changes instead of every interval, see _sleep()
+        # it is created on the first sleep, collectors driven by TailEngine never sleep
+        self.watcher = None
+        self.changed = True
+        self.missing = False
+
+        # failures of every upstream address and every server, see count_failure()
+        self.upstream_failures = CappedCounters(max_failure_names)
+        self.server_failures = CappedCounters(max_failure_names)
+
+        # other errors are summarized by templates and sent as events, see send_templates()
+        self.templates = ErrorTemplates(max_templates=max_templates) if max_templates else None
+        self.top_templates = top_templates
+
+        # lines of lower levels are only counted, not parsed, see collect()
+        if min_level and min_level not in ERROR_LOG_LEVELS:
+            context.log.warning('unknown error log level "%s", lines of all levels will be parsed' % min_level)
+            min_level = None
+        self.min_level = min_level
+        self.skipped_levels = ERROR_LOG_LEVELS[:ERROR_LOG_LEVELS.index(min_level)] if min_level else ()
 
     def init_counters(self):
         for counter in self.counters:
             self.statsd.incr(counter, value=0)
 
+    def _sleep(self):
+        if not isinstance(self.tail, FileTail):
+            super(NginxErrorLogsCollector, self)._sleep()
+            return
+
+        if self.watcher is None:
+            # writes made before the watch started would not wake it, so the first sleep is a plain one
+            self.watcher = FileWatcher(self.filename)
+            super(NginxErrorLogsCollector, self)._sleep()
+            return
+
+        if not self.tail.caught_up:
+            # the previous pass left unread lines (budget, rotation), the watcher won't report them again
+            super(NginxErrorLogsCollector, self)._sleep()
+            self.changed = True
+            return
+
+        self.changed = self.watcher.wait(self.interval)
+
     def collect(self):
         # If log_level is <= warn (e.g. debug, info, notice, warn)
         if ERROR_LOG_LEVELS.index(self.level) <= 3:
             self.init_counters()  # set all error counters to 0
 
+        if not self.changed:
+            # nothing was written to the log, do not even stat it
+            return
+
         count = 0
+        skipped = dict.fromkeys(self.skipped_levels, 0)
         for line in self.tail:
             count += 1
+
+            if skipped:
+                # the level goes right after the timestamp: "2015/07/14 08:42:57 [debug] ..."
+                level = line[21:line.find(']', 21, 29)]
+                if level in skipped:
+                    skipped[level] += 1
+                    continue
+
             try:
                 error = self.parser.parse(line)
             except:
@@ -53,9 +166,86 @@ class NginxErrorLogsCollector(AbstractCollector):
             if error:
                 try:
                     self.statsd.incr(error)
+                    if error in self.failures:
+                        self.count_failure(line)
                 except Exception as e:
                     exception_name = e.__class__.__name__
                     context.log.error('failed to collect error log metrics due to %s' % exception_name)
                     context.log.debug('additional info:', exc_info=True)
+            elif self.templates is not None:
+                fields = self.parser.parse_fields(line)
+                if fields is not None:
+                    self.templates.add(fields['level'], fields['message'])
+
+        self.flush_failures()
+        self.send_templates()
+
+        skipped_counters = [
+            ('errorlog.skipped|%s' % skipped_level, value) for skipped_level, value in skipped.iteritems() if value
+        ]
+        if skipped_counters:
+            self.statsd.bulk(counters=skipped_counters)
 
         context.log.debug('%s processed %s lines from %s' % (self.object.id, count, self.filename))
+
+        self.check_missing()
+
+    def count_failure(self, line):
+        """
+        Counts a failure for the upstream and the server of the line
+
+        :param line: log line
+        """
+        fields = self.parser.parse_fields(line)
+        if fields is None:
+            return
+
+        if 'upstream' in fields:
+            self.upstream_failures.incr(upstream_address(fields['upstream']))
+        if 'server' in fields:
+            self.server_failures.incr(fields['server'])
+
+    def flush_failures(self):
+        """
+        nginx.upstream.failed|<upstream address>
+        nginx.server.upstream.failed|<server name>
+        """
+        counters = []
+        for metric_name, failures in (
+            ('upstream.failed', self.upstream_failures),
+            ('server.upstream.failed', self.server_failures)
+        ):
+            for name, value in failures.flush():
+                counters.append(('%s|%s' % (metric_name, name), value))
+
+        if counters:
+            self.statsd.bulk(counters=counters)
+
+    def send_templates(self):
+        """
+        Sends the most frequent templates of errors that are not counted by metrics as events
+        Serious ones (error and above) are warnings, the rest is info
+        """
+        if self.templates is None:
+            return
+
+        for template, level, count in self.templates.flush(top=self.top_templates):
+            self.eventd.event(
+                level=WARNING if level in self.serious_levels else INFO,
+                message='nginx error log %s: [%s] %s' % (self.filename, level, template),
+                counter=count
+            )
+
+    def check_missing(self):
+        """
+        Sends an event when the log file disappears and when it is back
+        """
+        missing = isinstance(self.tail, FileTail) and self.tail.missing_since is not None
+        if missing == self.missing:
+            return
+
+        self.missing = missing
+        if missing:
+            self.eventd.event(level=WARNING, message='nginx log %s is missing' % self.filename)
+        else:
+            self.eventd.event(level=INFO, message='nginx log %s is found again' % self.filename)
@@ -49,6 +49,7 @@ class NginxConfig(object):
         self.prefix = prefix
         self.log_formats = {}
         self.access_logs = {}
+        self.gzip_access_logs = {}  # log name -> compression level, for logs written with the gzip parameter
         self.error_logs = {}
         self.stub_status_urls = []
         self.plus_status_external_urls = []
@@ -134,16 +135,32 @@ class NginxConfig(object):
                         continue
 
                     parts = filter(lambda x: x, ac_log_definition.split(' '))
-                    log_format = None if len(parts) == 1 else parts[1]
                     log_name = parts[0]
                     log_name = re.sub('[\'"]', '', log_name)  # remove all ' and "
 
+                    # format is optional, parameters (buffer=, gzip, if= etc) go after it
+                    parameters = parts[1:]
+                    log_format = None
+                    if parameters and parameters[0] != 'gzip' and '=' not in parameters[0]:
+                        log_format = parameters.pop(0)
+
                     if log_name.startswith('syslog'):
                         continue
                     elif not log_name.startswith('/'):
                         log_name = '%s/%s' % (self.prefix, log_name)
 
                     self.access_logs[log_name] = log_format
+
+                    for parameter in parameters:
+                        if parameter == 'gzip':
+                            self.gzip_access_logs[log_name] = 1  # nginx default level
+                        elif parameter.startswith('gzip='):
+                            try:
+                                self.gzip_access_logs[log_name] = int(parameter[5:])
+                            except ValueError:
+                                # the log is compressed anyway, only the level is unknown
+                                context.log.warning('bad %s of access_log %s, ignored' % (parameter, log_name))
+                                self.gzip_access_logs[log_name] = 1
             elif key == 'log_format':
                 for k, v in value.iteritems():
                     self.log_formats[k] = v
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import re
 
+from collections import OrderedDict
+
 from amplify.agent.util.escape import prep_raw
 
 
@@ -12,6 +14,16 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+def escape_char(char):
+    """
+    Escapes a char of the log format for the regex
+    """
+    if char.isalpha() or char.isdigit():
+        return char
+    else:
+        return '\\%s' % char
+
+
 REQUEST_RE = re.compile(r'(?P<http_method>[A-Z]+) (?P<request_uri>/.*) HTTP/(?P<http_version>[\d\.]+)')
 
 
@@ -54,73 +66,412 @@ class NginxAccessLogParser(object):
         'http_version': ['[\d\.]+', str],
     }
 
-    def __init__(self, raw_format=None):
+    # nginx escapes double quotes and control chars (like tab) in every value it writes to the access log,
+    # so they always terminate a variable
+    escaped_chars = '"\t'
+
+    # separators that never show up inside values of these variables
+    separators = {
+        'remote_addr': ' ',
+        'remote_port': ' ',
+        'server_addr': ' ',
+        'server_port': ' ',
+        'server_protocol': ' ',
+        'scheme': ' ',
+        'host': ' ',
+        'request_method': ' ',
+        'request_time': ' ]',
+        'msec': ' ]',
+        'time_iso8601': ' ]',
+        'time_local': ']',
+        'upstream_cache_status': ' ',
+        'gzip_ratio': ' ',
+    }
+
+    def __init__(self, raw_format=None, fields=None):
         """
         Takes raw format and generates regex
         :param raw_format: raw log format
+        :param fields: names of variables to capture, "prefix_*" takes all variables with the prefix.
+                       Other variables are matched, but not captured and not converted. None means all.
         """
         self.raw_format = self.combined_format if raw_format is None else raw_format
-
-        self.keys = []
-        self.regex_string = r''
-        self.regex = None
-        current_key = None
+        self.fields = None if fields is None else tuple(sorted(set(fields)))
 
         self.raw_format = prep_raw(self.raw_format)
 
-        def finalize_key():
-            key_without_dollar = current_key[1:]
-            self.keys.append(key_without_dollar)
-            rxp = self.common_variables.get(key_without_dollar, self.default_variable)[0]
-            # Handle formats with multiple instances of the same variable.
-            var_count = self.keys.count(key_without_dollar)
-            if var_count > 1:  # Duplicate variables will be named starting at 2 (var, var2, var3, etc...)
-                regex_var_name = '%s%s' % (key_without_dollar, var_count)
-            else:
-                regex_var_name = key_without_dollar
-            self.regex_string += '(?P<%s>%s)' % (regex_var_name, rxp)
+        self.tokens = self.tokenize(self.raw_format)
+        self.keys = [key for literal, key in self.tokens if key]
+        self.captured_keys = [key for key in self.keys if self.captures(key)]
+        self.regex_string = self.build_regex_string(self.tokens)
+        self.regex = re.compile(self.regex_string)
+        self.split_plan = self.build_split_plan(self.tokens)
 
-        for char in self.raw_format:
+        self.parse = self.build_parse_function()
+        self.parse_chunk = self.build_parse_function(chunk=True)
+
+    def captures(self, key):
+        """
+        Checks that the variable is requested by fields
+
+        :param key: variable name
+        :return: bool
+        """
+        if self.fields is None:
+            return True
+
+        for field in self.fields:
+            if field == key or (field.endswith('*') and key.startswith(field[:-1])):
+                return True
+        return False
+
+    def tokenize(self, raw_format):
+        """
+        Splits raw format to a list of (literal, variable) tokens
+        Exactly one element of every token is set, another one is None
+
+        :param raw_format: raw log format
+        :return: list of tuples
+        """
+        tokens = []
+        current_key = None
+        literal = ''
+
+        for char in raw_format:
             if current_key:
                 # if there's a current key
                 if char.isalpha() or char == '_':
                     # continue building key
                     current_key += char
+                    continue
                 else:
                     # finalize current_key
-                    finalize_key()
-
-                    if char == '$':
-                        # if there's a new key - create it
-                        current_key = char
-                    else:
-                        # otherwise - add char to regex
-                        current_key = None
-                        if char.isalpha() or char.isdigit():
-                            self.regex_string += char
-                        else:
-                            self.regex_string += '\%s' % char
+                    tokens.append((None, current_key[1:]))
+                    current_key = None
+
+            if char == '$':
+                # if there's a new key - create it
+                if literal:
+                    tokens.append((literal, None))
+                    literal = ''
+                current_key = char
             else:
-                # if there's no current key
-                if char == '$':
-                    current_key = char
-                else:
-                    if char.isalpha() or char.isdigit():
-                        self.regex_string += char
-                    else:
-                        self.regex_string += '\%s' % char
+                literal += char
 
         # key can be the last one element in a string
         if current_key:
-            finalize_key()
+            tokens.append((None, current_key[1:]))
+        elif literal:
+            tokens.append((literal, None))
 
-        self.regex = re.compile(self.regex_string)
+        return tokens
+
+    def variable_regex(self, key, delimiter):
+        """
+        Returns regex for a variable
+
+        Variables without a specific regex are bounded by the first char of the literal that follows them,
+        if that char can't be a part of the value, so the engine doesn't have to backtrack over the whole line.
+        The last variable keeps its generic regex to swallow any unexpected tail of a line.
+
+        :param key: variable name
+        :param delimiter: first char of the following literal or None if the variable is the last one
+        :return: str regex
+        """
+        rxp = self.common_variables.get(key, self.default_variable)[0]
+        if rxp != self.default_variable[0] or delimiter is None:
+            return rxp
+
+        if delimiter in self.escaped_chars or delimiter in self.separators.get(key, ''):
+            return '[^%s]*' % escape_char(delimiter)
+        else:
+            return '.+?'
+
+    def build_regex_string(self, tokens):
+        """
+        Builds anchored regex string from tokens
+        Variables that are not captured become non-capturing groups
+
+        :param tokens: list of tuples from tokenize()
+        :return: str regex
+        """
+        regex_string = r'^'
+        seen = []
+
+        variable_indexes = [i for i, (literal, key) in enumerate(tokens) if key]
+        last_variable_index = variable_indexes[-1] if variable_indexes else None
+
+        for i, (literal, key) in enumerate(tokens):
+            if literal:
+                regex_string += ''.join(escape_char(char) for char in literal)
+                continue
+
+            # find out what stops the variable
+            delimiter = None
+            if i != last_variable_index and i + 1 < len(tokens):
+                next_literal = tokens[i + 1][0]
+                delimiter = next_literal[0] if next_literal else None
+
+            rxp = self.variable_regex(key, delimiter)
+            if not self.captures(key):
+                regex_string += '(?:%s)' % rxp
+                continue
+
+            # Handle formats with multiple instances of the same variable.
+            seen.append(key)
+            var_count = seen.count(key)
+            if var_count > 1:  # Duplicate variables will be named starting at 2 (var, var2, var3, etc...)
+                regex_var_name = '%s%s' % (key, var_count)
+            else:
+                regex_var_name = key
+
+            regex_string += '(?P<%s>%s)' % (regex_var_name, rxp)
+
+        return regex_string + '$'
+
+    def build_split_plan(self, tokens):
+        """
+        Builds a plan to cut variables out of a line with a single str.split() call instead of the regex
+
+        It's possible if all variables are separated by the same one-char literal, every variable except
+        the last one is bounded by that char (or consists of digits only) and the last one takes the rest
+        of the line. Prefix and suffix literals are allowed. The plan gives exactly the same values as the regex.
+
+        A chain of str.find() calls for arbitrary literals was measured to be slower than the delimiter-aware
+        regex, so other formats stay with the regex.
+
+        :param tokens: list of tuples from tokenize()
+        :return: (prefix, separator, suffix, kinds) or None if the format is not suitable
+        """
+        if not self.keys:
+            return None
+
+        tokens = list(tokens)
+        prefix = tokens.pop(0)[0] if tokens[0][0] else ''
+        suffix = tokens.pop()[0] if tokens[-1][0] else ''
 
-    def parse(self, line):
+        keys = [key for literal, key in tokens[::2]]
+        separators = set(literal for literal, key in tokens[1::2])
+
+        # variables must be separated by the same one-char literal
+        if None in keys or len(keys) != len(self.keys):
+            return None
+
+        separator = None
+        if len(keys) > 1:
+            if len(separators) != 1:
+                return None
+            separator = separators.pop()
+            if separator is None or len(separator) != 1:
+                return None
+
+        kinds = []
+        for i, key in enumerate(keys):
+            is_last = i + 1 == len(keys)
+            rxp = self.variable_regex(key, None if is_last else separator)
+
+            if rxp == '\\d+' and not (separator or '').isdigit():
+                kinds.append('digits')
+            elif is_last and rxp == '.+':
+                kinds.append('any')
+            elif not is_last and rxp == '[^%s]*' % escape_char(separator):
+                kinds.append('bounded')
+            else:
+                return None
+
+        return prefix, separator, suffix, kinds
+
+    def split_source(self, split_plan, indent, skip):
+        """
+        Generates a source for cutting variables out of the line by the split plan
+        Runs the skip statement if the line doesn't fit the format
+
+        :param split_plan: split plan from build_split_plan()
+        :param indent: str indent for source lines
+        :param skip: str statement to leave the line
+        :return: list of source lines
+        """
+        prefix, separator, suffix, kinds = split_plan
+        names = ['v%s' % i for i in xrange(len(kinds))]
+        source = []
+
+        if prefix:
+            source.extend([
+                'if not line.startswith(%r):' % prefix,
+                '    %s' % skip,
+            ])
+        if suffix:
+            source.extend([
+                'if not line.endswith(%r):' % suffix,
+                '    %s' % skip,
+            ])
+
+        if prefix or suffix:
+            source.append('line = line[%s:len(line) - %s]' % (len(prefix), len(suffix)))
+
+        if len(kinds) > 1:
+            source.extend([
+                'values = line.split(%r, %s)' % (separator, len(kinds) - 1),
+                'if len(values) != %s:' % len(kinds),
+                '    %s' % skip,
+                '%s, = values' % ', '.join(names),
+            ])
+        else:
+            source.append('v0 = line')
+
+        for name, kind in zip(names, kinds):
+            if kind == 'digits':
+                source.extend([
+                    'if not %s.isdigit():' % name,
+                    '    %s' % skip,
+                ])
+            elif kind == 'any':
+                source.extend([
+                    'if not %s:' % name,
+                    '    %s' % skip,
+                ])
+
+        return [indent + line for line in source]
+
+    def conversion_source(self, indent):
+        """
+        Generates a source which fills the result dict from positional values v0, v1, ...
+        All value conversions are inlined
+
+        :param indent: str indent for source lines
+        :return: list of source lines
+        """
+        names = {}  # key -> local variable name of its first occurrence
+        for i, key in enumerate(self.keys):
+            if key not in names and self.captures(key):
+                names[key] = 'v%s' % i
+
+        source = []
+        for key in sorted(names, key=self.keys.index):
+            name = names[key]
+            func = self.common_variables.get(key, self.default_variable)[1]
+
+            if key.endswith('_time'):
+                # time variables should be parsed to array of float
+                # values above 10000000 are a workaround for an old nginx bug with time. ask lonerr@ for details
+                # a single value (no upstream switches) is the most common case, it needs no intermediate lists
+                # empty value (nginx writes it when the variable is not set) is skipped like "-"
+                source.extend([
+                    'if %s == "-" or not %s:' % (name, name),
+                    '    pass',
+                    'elif "," in %s or " " in %s:' % (name, name),
+                    '    array_value = [x for x in map(float, %s.replace(" ", "").split(",")) '
+                    'if x <= 10000000]' % name,
+                    '    if array_value:',
+                    '        result["%s"] = array_value' % key,
+                    'else:',
+                    '    x = float(%s)' % name,
+                    '    if x <= 10000000:',
+                    '        result["%s"] = [x]' % key,
+                ])
+            elif func is str:
+                source.append('result["%s"] = %s' % (key, name))
+            else:
+                # for example gzip ratio can be '-' and float
+                source.extend([
+                    'try:',
+                    '    result["%s"] = %s(%s)' % (key, func.__name__, name),
+                    'except ValueError:',
+                    '    result["%s"] = 0' % key,
+                ])
+
+        # parse sub fields
+        if 'request' in names:
+            request_keys = sorted(REQUEST_RE.groupindex, key=REQUEST_RE.groupindex.get)
+            source.extend([
+                'req = request_match(%s)' % names['request'],
+                'if req:',
+                '    %s = req.groups()' % ', '.join('result["%s"]' % req_key for req_key in request_keys),
+                'else:',
+                '    result["malformed"] = True',
+            ])
+
+        return [indent + line for line in source]
+
+    def build_parse_function(self, split=True, chunk=False):
+        """
+        Generates a parse function specialized for the format
+
+        The function gets values by position - either with the split plan (if the format allows it)
+        or from regex groups - and has all value conversions inlined, so there are no per-key lookups
+        for every line. It returns exactly the same dict as parse_generic().
+
+        The chunk function takes a block of newline separated lines (as FileTail.readchunks() gives them)
+        and yields a dict for every line that fits the format, or None if the line failed to be parsed.
+        This saves a function call and an exception handler setup in the collector for every line.
+        With start and step arguments it parses only every step-th line of the block beginning from start.
+
+        :param split: use the split plan if possible
+        :param chunk: generate a chunk function
+        :return: function(line) -> dict or function(chunk, start=0, step=1) -> generator of dicts
+        """
+        group_names = ['v%s' % i for i, key in enumerate(self.keys) if self.captures(key)]
+
+        if chunk:
+            indent, skip = '        ', 'continue'
+            source = [
+                'def parse_chunk(chunk, start=0, step=1):',
+                '    lines = chunk.split("\\n")',
+                '    if start or step > 1:',
+                '        lines = lines[start::step]',
+                '    for line in lines:',
+                '        line = line.rstrip()',
+                '        if not line:',
+                '            continue',
+                '        result = {"malformed": False}',
+            ]
+        else:
+            indent, skip = '    ', 'return result'
+            source = [
+                'def parse(line):',
+                '    result = {"malformed": False}',
+            ]
+
+        if split and self.split_plan:
+            source.extend(self.split_source(self.split_plan, indent, skip))
+        else:
+            source.extend([
+                indent + 'common = match(line)',
+                indent + 'if not common:',
+                indent + '    %s' % skip,
+            ])
+            if group_names:
+                source.append(indent + '%s, = common.groups()' % ', '.join(group_names))
+
+        if chunk:
+            # a failed conversion must not stop the generator
+            source.append(indent + 'try:')
+            source.extend(self.conversion_source(indent + '    ') or [indent + '    pass'])
+            source.extend([
+                indent + 'except Exception:',
+                indent + '    result = None',
+                indent + 'yield result',
+            ])
+        else:
+            source.extend(self.conversion_source(indent))
+            source.append('    return result')
+
+        namespace = {
+            'match': self.regex.match,
+            'request_match': REQUEST_RE.match,
+            'int': int,
+            'float': float,
+        }
+        exec('\n'.join(source), namespace)
+        return namespace['parse_chunk' if chunk else 'parse']
+
+    def parse_generic(self, line):
         """
         Parses the line and if there are some special fields - parse them too
         For example we can get HTTP method and HTTP version from request
 
+        Generic version of parse function, works for any format
+
         :param line: log line
         :return: dict with parsed info
         """
@@ -129,7 +480,7 @@ class NginxAccessLogParser(object):
         # parse the line
         common = self.regex.match(line)
         if common:
-            for key in self.keys:  # TODO: Remove extra processing by using a set of keys.
+            for key in self.captured_keys:  # TODO: Remove extra processing by using a set of keys.
                 func = self.common_variables.get(key, self.default_variable)[1]
                 try:
                     value = func(common.group(key))
@@ -140,7 +491,7 @@ class NginxAccessLogParser(object):
                 # time variables should be parsed to array of float
                 if key.endswith('_time'):
                     # skip empty vars
-                    if value != '-':
+                    if value and value != '-':
                         array_value = []
                         for x in value.replace(' ', '').split(','):
                             x = float(x)
@@ -163,4 +514,50 @@ class NginxAccessLogParser(object):
             else:
                 result['malformed'] = True
 
-        return result
\ No newline at end of file
+        return result
+
+
+class NginxAccessLogParserCache(object):
+    """
+    Process-wide LRU cache of access log parsers
+
+    Parsers keep no state between lines, so collectors of NginxObjects recreated after every reload
+    can share them instead of compiling the same formats again.
+    """
+
+    def __init__(self, size=256):
+        """
+        :param size: max number of parsers to keep
+        """
+        self.size = size
+        self.parsers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, raw_format=None, fields=None):
+        """
+        Returns a parser for the format, takes it from the cache if possible
+
+        :param raw_format: raw log format
+        :param fields: names of variables to capture (see NginxAccessLogParser)
+        :return: NginxAccessLogParser
+        """
+        key = (
+            prep_raw(NginxAccessLogParser.combined_format if raw_format is None else raw_format),
+            None if fields is None else tuple(sorted(set(fields)))
+        )
+
+        parser = self.parsers.pop(key, None)
+        if parser is None:
+            self.misses += 1
+            parser = NginxAccessLogParser(raw_format, fields=fields)
+            if len(self.parsers) >= self.size:
+                self.parsers.popitem(last=False)  # drop the least recently used one
+        else:
+            self.hits += 1
+
+        self.parsers[key] = parser
+        return parser
+
+
+parser_cache = NginxAccessLogParserCache()
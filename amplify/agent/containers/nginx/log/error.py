@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import re
+import heapq
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -37,15 +38,49 @@ error_re = {
 }
 
 
+# every error above mentions one of these words, lines without them are not matched at all
+error_keywords = ('upstream', 'buffered')
+
+
+def build_error_regex(errors):
+    """
+    Combines regexes of all errors into one alternation, every alternative is a named group.
+    Alternatives go in the same order as separate regexes were tried, so the same error is found first.
+
+    :param errors: dict error name -> list of compiled regexes
+    :return: (compiled regex, dict group name -> error name)
+    """
+    alternatives, group_errors = [], {}
+    for error, regexps in errors.iteritems():
+        for regexp in regexps:
+            pattern = regexp.pattern
+            if pattern.endswith('.*'):
+                pattern = pattern[:-2]  # the rest of the line doesn't matter for re.match
+
+            group = 'e%d' % len(alternatives)
+            alternatives.append('(?P<%s>%s)' % (group, pattern))
+            group_errors[group] = error
+
+    return re.compile('|'.join(alternatives)), group_errors
+
+
 class NginxErrorLogParser(object):
     """
     Nginx error log parser
+
+    A line is matched only if it has one of error_keywords, and then by one combined regex
+    instead of trying every regex of error_re one by one.
     """
 
     short_name = 'nginx_elog'
 
     keys = []  # Included for compatibility with 0 counter handling.
 
+    context_fields = ('client', 'server', 'request', 'upstream', 'host')
+
+    def __init__(self):
+        self.regex, self.group_errors = build_error_regex(error_re)
+
     def parse(self, line):
         """
         Parses the line to find any kind of errors and return it once any first is found
@@ -53,8 +88,182 @@ class NginxErrorLogParser(object):
         :param line: log line
         :return: str or None: error
         """
-        for error, regexps in error_re.iteritems():
-            for regexp in regexps:
-                if re.match(regexp, line):
-                    return error
-        return None
+        for keyword in error_keywords:
+            if keyword in line:
+                break
+        else:
+            return None
+
+        match = self.regex.match(line)
+        if match is None:
+            return None
+        return self.group_errors[match.lastgroup]
+
+    def parse_fields(self, line):
+        """
+        Splits the line into fields by their positions, without regexes:
+        2015/07/14 08:42:57 [error] 28386#28386: *38698 message, client: 127.0.0.1, server: localhost, ...
+
+        :param line: log line
+        :return: dict with level, pid, tid, connection_id (None if there is no connection), message
+                 and context fields that are found (client, server, request, upstream, host)
+                 or None if it is not an error log line
+        """
+        if line[20:21] != '[':
+            return None
+
+        level_end = line.find('] ', 21)
+        pid_end = line.find('#', level_end + 2)
+        tid_end = line.find(': ', pid_end + 1)
+        if level_end == -1 or pid_end == -1 or tid_end == -1:
+            return None
+
+        pid, tid = line[level_end + 2:pid_end], line[pid_end + 1:tid_end]
+        if not pid.isdigit() or not tid.isdigit():
+            return None
+
+        fields = {
+            'level': line[21:level_end],
+            'pid': int(pid),
+            'tid': int(tid),
+            'connection_id': None
+        }
+
+        start = tid_end + 2
+        if line[start:start + 1] == '*':
+            connection_end = line.find(' ', start)
+            if connection_end != -1 and line[start + 1:connection_end].isdigit():
+                fields['connection_id'] = int(line[start + 1:connection_end])
+                start = connection_end + 1
+
+        # context goes after the message in this order, quoted values may contain ", "
+        context_start = line.find(', client: ', start)
+        if context_start == -1:
+            fields['message'] = line[start:]
+            return fields
+        fields['message'] = line[start:context_start]
+
+        position = context_start
+        for key in self.context_fields:
+            marker = ', %s: ' % key
+            key_start = line.find(marker, position)
+            if key_start == -1:
+                continue
+
+            value_start = key_start + len(marker)
+            if line[value_start:value_start + 1] == '"':
+                value_start += 1
+                value_end = line.find('"', value_start)
+            else:
+                value_end = line.find(', ', value_start)
+            if value_end == -1:
+                value_end = len(line)
+
+            fields[key] = line[value_start:value_end]
+            position = value_end
+        return fields
+
+
+def upstream_address(upstream):
+    """
+    Cuts the URI off the upstream of an error log line
+    "http://127.0.0.1:3000/api/metrics/" -> "http://127.0.0.1:3000"
+
+    :param upstream: str upstream field
+    :return: str scheme and address of the upstream
+    """
+    host_start = upstream.find('://')
+    host_start = 0 if host_start == -1 else host_start + 3
+    uri_start = upstream.find('/', host_start)
+    return upstream if uri_start == -1 else upstream[:uri_start]
+
+
+# variable parts of error messages, replaced in one pass, see mask_message()
+mask_re = re.compile(
+    r'(?P<ip>\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b)|'
+    r'(?P<path>(?<![^\s"\'(=])/[^\s"\',)]*)|'
+    r'(?P<hex>\b0x[0-9a-fA-F]+\b|\b(?=[a-fA-F]*\d)[0-9a-fA-F]{8,}\b)|'
+    r'(?P<number>\d+(?:\.\d+)?)'
+)
+
+
+def mask_message(message):
+    """
+    Replaces IPs, paths, hex ids and numbers with placeholders:
+    open() "/var/www/1.html" failed (2: No such file or directory) -> open() "<path>" failed (<number>: No such...)
+
+    :param message: str error message
+    :return: str template of the message
+    """
+    return mask_re.sub(lambda match: '<%s>' % match.lastgroup, message)
+
+
+class ErrorTemplates(object):
+    """
+    Counts error messages by their templates, see mask_message()
+
+    Not more than `max_templates` templates are kept. When a new one comes, the least frequently
+    seen one is evicted. Counts are halved on every flush, so templates that stopped appearing
+    can be evicted by new ones. Only the first `max_length` characters of a message are masked,
+    so the work per line doesn't depend on the line.
+
+    The least frequent template is found with a heap of counts that is not updated on every line:
+    counts only grow between flushes, so an outdated entry is pushed again with the current count
+    when it comes up, and the first up to date one is the minimum, see _evict().
+    """
+
+    def __init__(self, max_templates=100, max_length=256):
+        self.max_templates = max_templates
+        self.max_length = max_length
+        self.templates = {}  # template -> [level, count for eviction, count since the last flush]
+        self.heap = []  # (count for eviction when pushed, template), one per template
+
+    def add(self, level, message):
+        """
+        :param level: str error level
+        :param message: str error message
+        """
+        template = mask_message(message[:self.max_length])
+
+        entry = self.templates.get(template)
+        if entry is None:
+            if len(self.templates) >= self.max_templates:
+                self._evict()
+            entry = self.templates[template] = [level, 0, 0]
+            heapq.heappush(self.heap, (0, template))
+
+        entry[1] += 1
+        entry[2] += 1
+
+    def flush(self, top=10):
+        """
+        Returns the most frequent templates seen since the last flush
+
+        :param top: int number of templates
+        :return: list of (template, level, count) sorted by count
+        """
+        result = []
+        for template, entry in self.templates.iteritems():
+            level, count, recent = entry
+            if recent:
+                result.append((template, level, recent))
+            entry[1], entry[2] = count // 2, 0
+
+        # halved counts are lower than pushed ones, the heap is rebuilt
+        self.heap = [(entry[1], template) for template, entry in self.templates.iteritems()]
+        heapq.heapify(self.heap)
+
+        result.sort(key=lambda item: item[2], reverse=True)
+        return result[:top]
+
+    def _evict(self):
+        """
+        Removes the least frequently seen template
+        """
+        while True:
+            count, template = heapq.heappop(self.heap)
+            current = self.templates[template][1]
+            if current == count:
+                del self.templates[template]
+                return
+            heapq.heappush(self.heap, (current, template))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from amplify.agent.util import host
+from amplify.agent.util.tail import tail_checkpoints
+from amplify.agent.util.tailengine import tail_engine
 from amplify.agent.context import context
 from amplify.agent.containers.abstract import AbstractObject
 from amplify.agent.containers.nginx.collectors.accesslog import NginxAccessLogsCollector
@@ -10,7 +12,7 @@ from amplify.agent.containers.nginx.collectors.meta.centos import NginxCentosMet
 from amplify.agent.containers.nginx.collectors.metrics import NginxMetricsCollector
 from amplify.agent.containers.nginx.config.config import NginxConfig
 from amplify.agent.containers.nginx.collectors.config import NginxConfigCollector
-from amplify.agent.eventd import INFO
+from amplify.agent.eventd import INFO, WARNING
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -39,6 +41,22 @@ class NginxObject(AbstractObject):
         self.upload_config = self.data.get('upload_config') or default_config.get('upload_config', False)
         self.run_config_test = self.data.get('run_test') or default_config.get('run_test', False)
         self.upload_ssl = self.data.get('upload_ssl') or default_config.get('upload_ssl', False)
+        self.log_sampling = self.data.get('log_sampling') or default_config.get('log_sampling', False)
+        self.log_time_budget = self.data.get('log_time_budget') or default_config.get('log_time_budget', 5)
+        self.log_line_budget = self.data.get('log_line_budget') or default_config.get('log_line_budget', None)
+        self.log_engine = self.data.get('log_engine') or default_config.get('log_engine', False)
+        self.log_resume_max_bytes = self.data.get('log_resume_max_bytes') or \
+            default_config.get('log_resume_max_bytes', 50 * 1024 * 1024)
+        self.log_catchup_policy = self.data.get('log_catchup_policy') or \
+            default_config.get('log_catchup_policy', 'read')
+        self.log_catchup_threshold = self.data.get('log_catchup_threshold') or \
+            default_config.get('log_catchup_threshold', 100 * 1024 * 1024)
+        self.log_max_failure_names = self.data.get('log_max_failure_names') or \
+            default_config.get('log_max_failure_names', 100)
+        self.log_max_error_templates = self.data.get('log_max_error_templates') or \
+            default_config.get('log_max_error_templates', 100)
+        self.log_error_min_level = self.data.get('log_error_min_level') or \
+            default_config.get('log_error_min_level', 'warn')
 
         self.config = NginxConfig(self.conf_path, prefix=self.prefix)
         self.config.full_parse()
@@ -70,21 +88,33 @@ class NginxObject(AbstractObject):
             )
         ]
 
+        # log collectors run their own greenlets or are all driven by the tail engine, see start()
+        self.log_collectors = []
+
         # access logs
         for log_filename, format_name in self.config.access_logs.iteritems():
             log_format = self.config.log_formats.get(format_name)
             try:
-                self.collectors.append(
+                self.log_collectors.append(
                     NginxAccessLogsCollector(
                         object=self,
                         interval=self.intervals['logs'],
                         filename=log_filename,
-                        log_format=log_format
+                        log_format=log_format,
+                        sampling=self.log_sampling,
+                        time_budget=self.log_time_budget,
+                        line_budget=self.log_line_budget,
+                        resume_max_bytes=self.log_resume_max_bytes,
+                        catchup_policy=self.log_catchup_policy,
+                        catchup_threshold=self.log_catchup_threshold,
+                        gzip=log_filename in self.config.gzip_access_logs,
+                        lazy_tail=self.log_engine
                     )
                 )
 
                 # Send access log discovery event.
                 self.eventd.event(level=INFO, message='nginx access log %s found' % log_filename)
+                self.check_log_resumed(self.log_collectors[-1])
             except IOError as e:
                 exception_name = e.__class__.__name__
                 context.log.error(
@@ -96,17 +126,23 @@ class NginxObject(AbstractObject):
         # error logs
         for log_filename, log_level in self.config.error_logs.iteritems():
             try:
-                self.collectors.append(
+                self.log_collectors.append(
                     NginxErrorLogsCollector(
                         object=self,
                         interval=self.intervals['logs'],
                         filename=log_filename,
-                        level=log_level
+                        level=log_level,
+                        resume_max_bytes=self.log_resume_max_bytes,
+                        max_failure_names=self.log_max_failure_names,
+                        max_templates=self.log_max_error_templates,
+                        min_level=self.log_error_min_level,
+                        lazy_tail=self.log_engine
                     )
                 )
 
                 # Send error log discovery event.
                 self.eventd.event(level=INFO, message='nginx error log %s found' % log_filename)
+                self.check_log_resumed(self.log_collectors[-1])
             except IOError as e:
                 exception_name = e.__class__.__name__
                 context.log.error(
@@ -115,6 +151,40 @@ class NginxObject(AbstractObject):
                 )
                 context.log.debug('additional info:', exc_info=True)
 
+        if not self.log_engine:
+            self.collectors.extend(self.log_collectors)
+
+    def start(self):
+        if not self.running and self.log_engine:
+            for collector in self.log_collectors:
+                tail_engine.register(collector)
+            tail_engine.start()
+        super(NginxObject, self).start()
+
+    def stop(self, unregister=True):
+        if self.log_engine:
+            for collector in self.log_collectors:
+                tail_engine.unregister(collector)
+
+        # the next object for this nginx continues reading logs from here
+        for collector in self.log_collectors:
+            tail_checkpoints.release(collector.tail)
+
+        super(NginxObject, self).stop(unregister=unregister)
+
+    def check_log_resumed(self, collector):
+        """
+        Sends an event if reading of the log could not continue from the saved checkpoint
+
+        :param collector: log collector
+        """
+        if collector.tail.resume_error:
+            self.eventd.event(
+                level=WARNING,
+                message='nginx log %s is read from the end, previous position was dropped because %s' %
+                        (collector.filename, collector.tail.resume_error)
+            )
+
     def get_alive_stub_status_url(self):
         """
         Tries to get alive stub_status url
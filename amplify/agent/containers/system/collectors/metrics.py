@@ -9,6 +9,9 @@ from collections import defaultdict
 from amplify.agent.util import subp, host
 from amplify.agent.context import context
 from amplify.agent.containers.abstract import AbstractCollector
+from amplify.agent.containers.nginx.log.access import parser_cache
+from amplify.agent.containers.nginx.collectors.accesslog import log_stats
+from amplify.agent.util.tail import tail_checkpoints
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -47,6 +50,31 @@ class SystemMetricsCollector(AbstractCollector):
         """ send amplify.agent.status by default """
         self.statsd.agent('status', 1)
 
+        # access log parsers reused after nginx reloads
+        self.statsd.agent('parser_cache.hits', parser_cache.hits)
+        self.statsd.agent('parser_cache.misses', parser_cache.misses)
+
+        # access logs reading per file: bytes written but not read yet, lines read per second
+        # and bytes skipped to catch up since the previous report
+        # collectors of the old and the new nginx object may read the same file for a while after reload
+        files = {}
+        for collector, (filename, lag_bytes, lines_per_second, skipped_bytes) in log_stats.items():
+            file_stats = files.setdefault(filename, [0, 0.0, 0])
+            file_stats[0] = max(file_stats[0], lag_bytes)
+            file_stats[1] += lines_per_second
+            file_stats[2] += skipped_bytes
+            if skipped_bytes:
+                log_stats[collector] = (filename, lag_bytes, lines_per_second, 0)
+
+        for filename, (lag_bytes, lines_per_second, skipped_bytes) in files.iteritems():
+            self.statsd.agent('log.lag_bytes|%s' % filename, lag_bytes)
+            self.statsd.agent('log.lines_per_second|%s' % filename, lines_per_second)
+            self.statsd.agent('log.skipped_bytes|%s' % filename, skipped_bytes)
+
+        # logs that were removed and not created again yet
+        missing = len([tail for tail in tail_checkpoints.tails if tail.missing_since is not None])
+        self.statsd.agent('log.missing', missing)
+
     def virtual_memory(self):
         """ virtual memory """
         virtual_memory = psutil.virtual_memory()
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import time
-import copy
 import hashlib
 
 from amplify.agent import CommonDataTank, CommonDataClient
@@ -37,8 +36,8 @@ class Event(object):
         self.id = hashlib.md5('%s_%s' % (self.message, self.level)).hexdigest()
         self.counter = 1
 
-    def inc(self):
-        self.counter += 1
+    def inc(self, value=1):
+        self.counter += value
 
     def dict(self):
         return {
@@ -60,8 +59,9 @@ class EventdClient(CommonDataClient):
         super(EventdClient, self).__init__(*args, **kwargs)
         self.onetimers = {}
 
-    def event(self, level=DEBUG, message=None, onetime=False, ctime=None):
+    def event(self, level=DEBUG, message=None, onetime=False, ctime=None, counter=1):
         event = Event(level, message)
+        event.counter = counter  # the same event happened several times, for example in a log
 
         if ctime:  # Override the event timestamp.
             event.stamp = ctime
@@ -73,7 +73,7 @@ class EventdClient(CommonDataClient):
 
         if event.id in self.current:
             stored_event = self.current[event.id]
-            stored_event.inc()
+            stored_event.inc(counter)
         else:
             self.current[event.id] = event
 
@@ -86,8 +86,8 @@ class EventdClient(CommonDataClient):
         if not self.current:
             return
 
-        delivery = copy.deepcopy(self.current)
-        self.current = {}
+        # events are handed over as is and new ones are collected into a new buffer, nothing is copied
+        delivery, self.current = self.current, {}
 
         return {
             'object': self.object.definition,
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import copy
-
 from collections import defaultdict
 
 from amplify.agent import CommonDataTank, CommonDataClient
@@ -30,8 +28,8 @@ class MetadClient(CommonDataClient):
 
     def flush(self):
         if self.current:
-            delivery = copy.deepcopy(self.current)
-            self.current = defaultdict(dict)
+            # meta is handed over as is, collectors build a new dict every time, so nothing is copied
+            delivery, self.current = self.current, defaultdict(dict)
             return {
                 'object': self.object.definition,
                 'meta': delivery,
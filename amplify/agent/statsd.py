@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 import time
-import copy
 from collections import defaultdict
 
 from amplify.agent import Singleton
+from amplify.agent.util.sketch import QuantileSketch, LogLinearHistogram
 
 
 __author__ = "Mike Belov"
@@ -14,6 +14,49 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+def parse_list(value):
+    """
+    Config values come from the config file as strings and from the cloud as lists
+
+    :param value: str like "50, 99.9" or list
+    :return: list of str
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def timer_percentiles(settings, metric_name):
+    """
+    Percentiles reported for a timer: "percentiles.<metric name>" of the statsd config or "percentiles"
+
+    :param settings: dict statsd section of the agent config
+    :param metric_name: str full metric name
+    :return: list of (str name suffix, float percentile), for example ('pctl99_9', 99.9)
+    """
+    value = settings.get('percentiles.%s' % metric_name, settings.get('percentiles', '95'))
+
+    result = []
+    for item in parse_list(value):
+        try:
+            percentile = float(item)
+            if not 0 < percentile <= 100:
+                raise ValueError(item)
+        except ValueError:
+            if item not in bad_percentiles:
+                from amplify.agent.context import context
+                context.log.warning('bad percentile "%s" in statsd config, ignored' % item)
+                bad_percentiles.add(item)  # timers are flushed every interval, warn once
+            continue
+        result.append(('pctl%s' % item.replace('.', '_'), percentile))
+    return result
+
+
+bad_percentiles = set()
+
+
 class StatsdContainer(Singleton):
     def __init__(self, *args, **kwargs):
         self.clients = defaultdict(dict)
@@ -47,6 +90,9 @@ class StatsdContainer(Singleton):
 
 
 class StatsdClient(object):
+    # timer values are kept as is until there are more of them, then they are moved to a QuantileSketch
+    sketch_threshold = 1024
+
     def __init__(self, address=None, port=None, prefix=None, interval=None, object=None):
         # Import context as a class object to avoid circular import on statsd.  This could be refactored later.
         from amplify.agent.context import context
@@ -84,16 +130,34 @@ class StatsdClient(object):
         Sort the data set by value from highest to lowest and discard the highest 5% of the sorted samples.
         The next highest sample is the 95th percentile value for the data set.
 
+        Reported percentiles and histogram buckets are set in the statsd section of the config,
+        see timer_percentiles() and LogLinearHistogram.
+
+        Up to sketch_threshold samples are kept as is, so percentiles are exact. After that they are
+        moved to a QuantileSketch: memory stays constant and percentiles are within 1% of exact ones.
+
         :param name: metric name
         :param value: metric value
         """
         metric_name = '%s.%s' % (self.prefix, name)
 
         if metric_name in self.current['timer']:
-            self.current['timer'][metric_name].append(value)
+            self.add_timer_values(metric_name, (value,))
         else:
             self.current['timer'][metric_name] = [value]
 
+    def add_timer_values(self, metric_name, values):
+        """
+        Adds values to an existing timer, moves them to a sketch when there are too many
+
+        :param metric_name: full metric name
+        :param values: list of values
+        """
+        samples = self.current['timer'][metric_name]
+        samples.extend(values)
+        if len(samples) > self.sketch_threshold and not isinstance(samples, QuantileSketch):
+            self.current['timer'][metric_name] = QuantileSketch(samples)
+
     def incr(self, name, value=None, rate=None):
         """
         Simple counter with rate
@@ -127,6 +191,41 @@ class StatsdClient(object):
         else:
             self.current['counter'][metric_name][-1] = [last_stamp, last_value + value]
 
+    def bulk(self, counters=None, timers=None, averages=None):
+        """
+        Adds metrics that were aggregated by a caller (for example for all lines read from a log)
+        Works like incr(), timer() and average() calls for every metric, but reads the clock only once
+
+        :param counters: list of (metric name, value)
+        :param timers: list of (metric name, list of values)
+        :param averages: list of (metric name, list of values)
+        """
+        if counters:
+            timestamp = int(time.time())
+            current = self.current['counter']
+            for name, value in counters:
+                metric_name = '%s.%s' % (self.prefix, name)
+                if metric_name in current:
+                    last_stamp, last_value = current[metric_name][-1]
+                    current[metric_name][-1] = [last_stamp, last_value + value]
+                else:
+                    current[metric_name] = [[timestamp, value]]
+
+        for metric_type, metrics in (('timer', timers), ('average', averages)):
+            if not metrics:
+                continue
+
+            current = self.current[metric_type]
+            for name, values in metrics:
+                metric_name = '%s.%s' % (self.prefix, name)
+                if metric_name not in current:
+                    current[metric_name] = []
+
+                if metric_type == 'timer':
+                    self.add_timer_values(metric_name, values)
+                else:
+                    current[metric_name].extend(values)
+
     def agent(self, name, value):
         """
         Agent metrics
@@ -161,23 +260,45 @@ class StatsdClient(object):
         if not self.current:
             return
 
+        # the collected data is handed over as is and new one is collected into a new buffer, nothing is copied
         results = {}
-        delivery = copy.deepcopy(self.current)
-        self.current = defaultdict(dict)
+        delivery, self.current = self.current, defaultdict(dict)
 
         # histogram
         if 'timer' in delivery:
             timers = {}
             timestamp = int(time.time())
+            settings = self.context.app_config.get('statsd') or {}
+            histograms = set(parse_list(settings.get('histograms')))
             for metric_name, metric_values in delivery['timer'].iteritems():
                 if len(metric_values):
-                    metric_values.sort()
+                    if isinstance(metric_values, QuantileSketch):
+                        total, value_at = metric_values.sum, metric_values.value_at
+                    else:
+                        metric_values.sort()
+                        total, value_at = sum(metric_values), metric_values.__getitem__
+
                     length = len(metric_values)
-                    timers['G|%s' % metric_name] = [[timestamp, sum(metric_values) / float(length)]]
+                    timers['G|%s' % metric_name] = [[timestamp, total / float(length)]]
                     timers['C|%s.count' % metric_name] = [[timestamp, length]]
-                    timers['G|%s.max' % metric_name] = [[timestamp, metric_values[-1]]]
-                    timers['G|%s.median' % metric_name] = [[timestamp, metric_values[int(round(length / 2 - 1))]]]
-                    timers['G|%s.pctl95' % metric_name] = [[timestamp, metric_values[-int(round(length * .05))]]]
+                    timers['G|%s.max' % metric_name] = [[timestamp, value_at(-1)]]
+                    timers['G|%s.median' % metric_name] = [[timestamp, value_at(int(round(length / 2 - 1)))]]
+
+                    for suffix, percentile in timer_percentiles(settings, metric_name):
+                        # discard the highest (100 - percentile)% of values, but at least one
+                        rank = -max(int(round(length * (100 - percentile) / 100.0)), 1)
+                        timers['G|%s.%s' % (metric_name, suffix)] = [[timestamp, value_at(rank)]]
+
+                    if metric_name in histograms:
+                        histogram = LogLinearHistogram()
+                        if isinstance(metric_values, QuantileSketch):
+                            for value, count in metric_values.counts():
+                                histogram.add(value, count)
+                        else:
+                            histogram.extend(metric_values)
+
+                        for bucket, count in histogram.items():
+                            timers['C|%s.bucket|%s' % (metric_name, bucket)] = [[timestamp, count]]
             results['timer'] = timers
 
         # counters
@@ -10,6 +10,7 @@ from amplify.agent.context import context
 from amplify.agent.util import loader
 from amplify.agent.bridge import Bridge
 from amplify.agent.util.threads import spawn
+from amplify.agent.util.tail import tail_checkpoints
 from amplify.agent.containers.abstract import definition_id
 from amplify.agent.errors import AmplifyCriticalException
 
@@ -102,6 +103,7 @@ class Supervisor(Singleton):
                     pass
 
                 self.check_bridge()
+                tail_checkpoints.save()
             except OSError as e:
                 if e.errno == 12:  # OSError errno 12 is a memory error (unable to allocate, out of memory, etc.)
                     context.default_log.error('OSError: [Errno %s] %s' % (e.errno, e.message), exc_info=True)
@@ -115,6 +117,8 @@ class Supervisor(Singleton):
         for container in self.containers.itervalues():
             container.stop_objects()
 
+        tail_checkpoints.save(force=True)
+
         bridge = Bridge()
         bridge.flush_metrics()
         bridge.flush_events()
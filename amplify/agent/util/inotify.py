@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import errno
+import weakref
+import struct
+import ctypes
+import ctypes.util
+
+from gevent import select
+
+from amplify.agent.context import context
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+EVENTS_BUFFER_SIZE = 64 * 1024
+
+
+def load_libc():
+    """
+    Loads libc if it has inotify functions (Linux 2.6.27+, glibc 2.9+)
+
+    :return: ctypes.CDLL or None
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+    if not all(hasattr(libc, name) for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch')):
+        return None
+    return libc
+
+
+libc = load_libc()
+
+
+class Inotify(object):
+    """
+    One inotify instance for all watched files.
+
+    Instances are limited per user (fs.inotify.max_user_instances, 128 by default), watches are much cheaper,
+    so every path gets one watch here and its events are handed to the FileWatchers interested in it.
+    """
+
+    def __init__(self):
+        self.fd = None
+        self.watchers = {}  # wd -> WeakSet of FileWatcher
+
+    def start(self):
+        """
+        Creates the inotify instance on the first call
+
+        :return: bool True if inotify can be used
+        """
+        if libc is None:
+            return False
+
+        if self.fd is None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            self.fd = fd
+        return True
+
+    def add_watch(self, path, mask, watcher):
+        """
+        Watches the path for the watcher, paths watched already keep their watch
+
+        :param path: str path
+        :param mask: int inotify events
+        :param watcher: FileWatcher
+        :return: int watch descriptor
+        """
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        self.watchers.setdefault(wd, weakref.WeakSet()).add(watcher)
+        return wd
+
+    def rm_watch(self, wd, watcher):
+        """
+        Stops watching for the watcher, the watch is removed when nobody else needs it
+
+        :param wd: int watch descriptor
+        :param watcher: FileWatcher
+        """
+        watchers = self.watchers.get(wd)
+        if watchers is None:
+            return
+
+        watchers.discard(watcher)
+        if not watchers:
+            del self.watchers[wd]
+            libc.inotify_rm_watch(self.fd, wd)
+
+    def dispatch(self):
+        """
+        Reads all queued events and hands them to watchers
+        """
+        for wd, mask, name in self._events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, every file might have changed or have been recreated
+                for watchers in self.watchers.values():
+                    for watcher in list(watchers):
+                        watcher.overflow()
+                continue
+
+            for watcher in list(self.watchers.get(wd, ())):
+                watcher.handle(wd, mask, name)
+
+            if mask & IN_IGNORED:
+                # the kernel removed the watch (the file is gone)
+                self.watchers.pop(wd, None)
+
+    def _events(self):
+        """
+        :return: list of (wd, mask, name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, EVENTS_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            if not data:
+                break
+
+            position = 0
+            while position < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, position)
+                position += EVENT_HEADER.size
+                name = data[position:position + length].rstrip('\0')
+                position += length
+                events.append((wd, mask, name))
+        return events
+
+
+shared_inotify = Inotify()
+
+
+class FileWatcher(object):
+    """
+    Waits until a file is modified, rotated or recreated.
+
+    The file and its directory are watched with the shared inotify instance, so an idle log doesn't wake
+    its collector until the interval is over, and a busy one wakes it early.
+    Bursts of events are coalesced: after the first event the watcher waits `debounce` seconds more.
+    If inotify is not available (other OS, old kernel, out of watches), it just sleeps.
+    """
+
+    file_mask = IN_MODIFY | IN_MOVE_SELF
+    directory_mask = IN_CREATE | IN_MOVED_TO
+
+    def __init__(self, filename, debounce=0.5):
+        self.filename = os.path.abspath(filename)
+        self.directory, self.basename = os.path.split(self.filename)
+        self.debounce = debounce
+        self.enabled = False
+        self.changed = False
+        self.file_wd = None
+        self.directory_wd = None
+
+        try:
+            if not shared_inotify.start():
+                return
+            self.directory_wd = shared_inotify.add_watch(self.directory, self.directory_mask, self)
+            self.enabled = True
+        except OSError as e:
+            context.log.debug(
+                'failed to watch %s with inotify due to %s, will poll it' % (self.filename, os.strerror(e.errno))
+            )
+            self.close()
+            return
+
+        # a missing file is watched when it's created
+        self._watch_file()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for wd in (self.file_wd, self.directory_wd):
+            if wd is not None:
+                shared_inotify.rm_watch(wd, self)
+        self.file_wd = self.directory_wd = None
+        self.enabled = False
+
+    def wait(self, timeout):
+        """
+        Waits for changes of the file
+
+        :param timeout: float max seconds to wait
+        :return: bool True if the file should be read, False if nothing happened
+        """
+        if not self.enabled:
+            time.sleep(timeout)
+            return True
+
+        deadline = time.time() + timeout
+        while not self.changed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            # every waiting watcher is woken, the first one reads the events for all of them
+            readable, _, _ = select.select([shared_inotify.fd], [], [], remaining)
+            if readable:
+                shared_inotify.dispatch()
+
+        if self.debounce:
+            time.sleep(min(self.debounce, max(deadline - time.time(), 0)))
+            shared_inotify.dispatch()
+
+        self.changed = False
+        return True
+
+    def handle(self, wd, mask, name):
+        """
+        Takes an event of the file or its directory
+
+        :param wd: int watch descriptor
+        :param mask: int event mask
+        :param name: str name of a file in the directory
+        """
+        if wd == self.file_wd:
+            if mask & IN_IGNORED:
+                self.file_wd = None
+            elif mask & (IN_MODIFY | IN_MOVE_SELF):
+                self.changed = True
+        elif wd == self.directory_wd and name == self.basename:
+            # a new file after rotation - watch it instead of the old one
+            self._watch_file()
+            self.changed = True
+
+    def overflow(self):
+        """
+        Events were lost, the file might have been recreated
+        """
+        self._watch_file()
+        self.changed = True
+
+    def _watch_file(self):
+        if self.file_wd is not None:
+            shared_inotify.rm_watch(self.file_wd, self)
+            self.file_wd = None
+
+        try:
+            self.file_wd = shared_inotify.add_watch(self.filename, self.file_mask, self)
+        except OSError:
+            # removed again, will be rewatched on the next IN_CREATE
+            pass
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import math
+import bisect
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class QuantileSketch(object):
+    """
+    Log-bucketed histogram of non-negative values (the DDSketch scheme) for quantiles of a large stream.
+
+    A value v goes to the bucket ceil(log(v) / log(gamma)), gamma = (1 + accuracy) / (1 - accuracy).
+    Any value returned by value_at() is within `accuracy` relative error of the real value of that rank
+    (1% by default). Values not greater than `min_value` are counted as zeros. Count, sum, min and max are exact.
+
+    Memory depends on the range of values, not on their number: with 1% accuracy values from
+    1 microsecond to 1000 seconds take about 1000 buckets. If there are more than `max_buckets`,
+    the lowest ones are merged, so only the lowest quantiles lose accuracy.
+    Sketches with the same accuracy can be merged.
+    """
+
+    def __init__(self, values=None, accuracy=0.01, min_value=1e-9, max_buckets=2048):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.max_buckets = max_buckets
+
+        self.buckets = {}  # index -> number of values
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+        if values:
+            self.extend(values)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        self.extend((value,))
+
+    def extend(self, values):
+        buckets, log, log_gamma, min_value = self.buckets, math.log, self.log_gamma, self.min_value
+        zeros, total = 0, 0.0
+        low = high = None
+
+        for value in values:
+            total += value
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+
+            if value > min_value:
+                index = int(math.ceil(log(value) / log_gamma))
+                buckets[index] = buckets.get(index, 0) + 1
+            else:
+                zeros += 1
+
+        if low is None:
+            return
+
+        self.count += len(values)
+        self.zeros += zeros
+        self.sum += total
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+        if len(buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other):
+        """
+        Adds all values of another sketch with the same accuracy
+
+        :param other: QuantileSketch
+        """
+        if other.count == 0:
+            return
+
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def value_at(self, rank):
+        """
+        Returns a value that has this rank among the sorted values, like sorted(values)[rank]
+
+        :param rank: int rank, negative ones count from the end
+        :return: float value
+        """
+        if not self.count:
+            raise IndexError('empty sketch')
+
+        rank %= self.count
+        if rank == self.count - 1:
+            return self.max
+        if rank < self.zeros or rank == 0:
+            return self.min
+
+        seen = 0
+        for value, count in self.counts():
+            seen += count
+            if seen > rank:
+                return value
+        return self.max
+
+    def counts(self):
+        """
+        :return: list of (value, number of values) for every bucket, sorted by value
+        """
+        result = [(self.min, self.zeros)] if self.zeros else []
+        for index in sorted(self.buckets):
+            # the middle of the bucket (gamma^(index-1), gamma^index] in terms of relative error
+            value = 2 * self.gamma ** index / (self.gamma + 1)
+            result.append((min(max(value, self.min), self.max), self.buckets[index]))
+        return result
+
+    def _collapse(self):
+        """
+        Merges the lowest buckets, so there are not more than max_buckets
+        """
+        indexes = sorted(self.buckets)
+        extra = len(indexes) - self.max_buckets
+        target = indexes[extra]
+        for index in indexes[:extra]:
+            self.buckets[target] += self.buckets.pop(index)
+
+
+class LogLinearHistogram(object):
+    """
+    Counts values in fixed buckets: 1, 2, ..., 9 units of every power of 10 from 10^min_exponent to 10^max_exponent,
+    so 0.001, 0.002, ..., 0.009, 0.01, 0.02, ..., 90, 100 and more than 100 (seconds) by default.
+    A bucket counts values that are not greater than its bound and greater than the previous one.
+    """
+
+    def __init__(self, min_exponent=-3, max_exponent=2):
+        self.bounds = [
+            float('%se%s' % (digit, exponent))
+            for exponent in xrange(min_exponent, max_exponent) for digit in xrange(1, 10)
+        ]
+        self.bounds.append(float('1e%s' % max_exponent))
+        self.values = [0] * (len(self.bounds) + 1)  # the last one is for values greater than all bounds
+
+    def add(self, value, count=1):
+        self.values[bisect.bisect_left(self.bounds, value)] += count
+
+    def extend(self, values):
+        bounds, counts, find = self.bounds, self.values, bisect.bisect_left
+        for value in values:
+            counts[find(bounds, value)] += 1
+
+    def items(self):
+        """
+        :return: list of (bucket name, number of values) of non-empty buckets, a name is a bound like "0.005" or "inf"
+        """
+        result = []
+        for bucket, count in enumerate(self.values):
+            if count:
+                name = '%g' % self.bounds[bucket] if bucket < len(self.bounds) else 'inf'
+                result.append((name, count))
+        return result
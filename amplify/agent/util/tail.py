@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
-from os import stat
+import os
+import time
+import errno
+import zlib
+import weakref
+
+import ujson
+
+from amplify.agent.context import context
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -9,10 +17,79 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+CHUNK_SIZE = 1024 * 1024
+
+# file states, see FileTail._file_state()
+PRESENT = 'present'
+ROTATED = 'rotated'
+MISSING = 'missing'
+
+GZIP_MAGIC = '\x1f\x8b\x08'  # ID1, ID2 and CM (deflate) of a gzip member header
+
+
+class GzipStream(object):
+    """
+    Incrementally decompresses gzip members appended to a file one after another, the way
+    nginx writes an access log with the `gzip` parameter - every flushed buffer is a complete member.
+
+    Data may be fed in arbitrary pieces: a member split between two reads is continued with the next one.
+    If reading starts in the middle of a member (the agent started after it was written) or a member
+    is broken, the data is skipped up to the next member header.
+    """
+
+    def __init__(self):
+        self._decompressor = None
+        self._head = ''  # the last bytes of the input that may be the beginning of a member header
+
+    def decompress(self, data):
+        """
+        :param data: str compressed bytes that follow the previous ones
+        :return: str decompressed bytes, may end with a part of a line
+        """
+        result = []
+        if self._head:
+            data = self._head + data
+            self._head = ''
+
+        while data:
+            if self._decompressor is None:
+                start = data.find(GZIP_MAGIC)
+                if start == -1:
+                    self._head = data[-len(GZIP_MAGIC) + 1:]
+                    break
+                data = data[start:]
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            try:
+                result.append(self._decompressor.decompress(data))
+            except zlib.error:
+                # not a member header after all or a broken member, look for the next one
+                self._decompressor = None
+                data = data[1:]
+                continue
+
+            # the member is over, everything after it belongs to the next one
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = None
+
+        return ''.join(result)
+
+
 class FileTail(object):
     """
     Creates an iterable object that returns only unread lines.
 
+    The file is read in blocks of CHUNK_SIZE bytes and split into lines here.
+    It is checked for rotation once per pass - when a pass starts after the
+    previous one reached the end of the file - not once per line. After a
+    rotation the rest of the old file is read before the new one, a file
+    truncated in place (copytruncate) is read from the beginning.
+
+    A gzip-compressed file (access_log ... gzip) is decompressed on the fly, see GzipStream.
+    Its offset counts compressed bytes, and decompressed lines that were not returned yet
+    are kept between passes instead of being read again.
+
     Based on some code of Pygtail
     pygtail - a python "port" of logtail2
     Copyright (C) 2011 Brad Greenlee <brad@footle.org>
@@ -20,21 +97,115 @@ class FileTail(object):
     https://raw.githubusercontent.com/bgreenlee/pygtail/master/pygtail/core.py
     """
 
-    def __init__(self, filename):
+    missing_min_delay = 1.0
+    missing_max_delay = 60.0
+
+    def __init__(self, filename, resume_max_bytes=None, gzip=False, lazy=False):
+        """
+        :param filename: str path to the file
+        :param resume_max_bytes: int if set, reading resumes from the saved checkpoint of the file
+                                 unless more than this number of bytes was written since then
+        :param gzip: bool the file consists of gzip members
+        :param lazy: bool do not open the file until the first read (TailEngine limits the number of open files)
+        """
         self.filename = filename
-        self._fh = None
+        self.gzip = gzip
+        self._stream = GzipStream() if gzip else None
+        self._fd = None
+        self._reading = False  # True from the first read of a pass until the end of the file is reached
+
+        # lines of the last block that were not returned yet (in reverse order) and an incomplete line after them
+        self._lines = []
+        self._pending = ''
 
-        # open a file and seek to the end
-        with open(self.filename, "r") as f:
-            f.seek(0, 2)
-            self._offset = f.tell()
+        # bytes read from the file (compressed ones for gzip), like offsets and backlog() count them
+        self.bytes_read = 0
+
+        # False if the last read stopped before the end of the file, so there is unread data without a stat
+        self.caught_up = True
+
+        # open a file and start from the end
+        # it stays open, so after a rotation the rest of the old file can be read
+        # a lazy tail only checks that the file can be read, rotations before the first read lose the old file
+        try:
+            if lazy:
+                file_stat = os.stat(self.filename)
+                if not os.access(self.filename, os.R_OK):
+                    raise OSError(errno.EACCES, os.strerror(errno.EACCES))
+            else:
+                self._fd = os.open(self.filename, os.O_RDONLY)
+                file_stat = os.fstat(self._fd)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, self.filename)
+        self._offset = file_stat.st_size
 
         # save inode to determine rotations
-        self._inode = stat(self.filename).st_ino
+        self._inode = file_stat.st_ino
+        self._rotated = False  # True while the old file is read to its end after a rotation
+
+        # time when the file was found missing, None if it is there
+        self.missing_since = None
+        self._missing_delay = 0
+        self._next_check = 0
+
+        # why the checkpoint was not used, if there was one
+        self.resume_error = None
+
+        # True if another tail reads the file (the collector of the previous nginx object during a reload)
+        # and this one should continue from its position instead of the checkpoint, see _take_over()
+        self._take_over_pending = False
+
+        if resume_max_bytes is not None and not self.gzip:
+            # a checkpoint in the middle of a member is useless without the state of the decompressor
+            if tail_checkpoints.reading(self.filename):
+                self._take_over_pending = True
+            else:
+                self._resume(resume_max_bytes)
+
+        tail_checkpoints.register(self)
+
+    def _resume(self, max_bytes):
+        """
+        Moves the offset back to the checkpoint if it is still valid
+        Otherwise stays at the end of the file and sets resume_error
+
+        :param max_bytes: int max number of unread bytes
+        """
+        checkpoint = tail_checkpoints.get(self.filename)
+        if checkpoint is None:
+            return
+
+        inode, offset = checkpoint
+        if inode != self._inode or offset > self._offset:
+            self.resume_error = 'the file was rotated'
+        elif self._offset - offset > max_bytes:
+            self.resume_error = '%s bytes were written, more than %s' % (self._offset - offset, max_bytes)
+        else:
+            self._offset = offset
+
+    def _take_over(self):
+        """
+        Moves the offset to the position of the previous tail of the file:
+        the one that still reads it or the one that was released last.
+        Called when the first pass starts, so lines read by the previous tail until then are not read again.
+        """
+        self._take_over_pending = False
+        position = tail_checkpoints.position(self.filename, exclude=self)
+        if position is not None and position[0] == self._inode:
+            self._offset = position[1]
 
     def __del__(self):
-        if self._filehandle():
-            self._filehandle().close()
+        self.close()
+
+    def close(self):
+        """
+        Closes the file, the next read reopens it at the current offset
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._rotated = False
+        self._end_pass()
 
     def __iter__(self):
         return self
@@ -43,29 +214,45 @@ class FileTail(object):
         """
         Return the next line in the file, updating the offset.
         """
-        try:
-            line = self._get_next_line()
-        except StopIteration:
-            # we've reached the end of the file;
-            self._update_offset()
-            raise
-        return line
+        if not self._lines and not self._read_lines():
+            # we've reached the end of the file
+            self._end_pass()
+            self.caught_up = True
+            raise StopIteration
 
-    def _file_was_rotated(self):
+        self.caught_up = False
+        line = self._lines.pop()
+        if not self.gzip:
+            self._offset += len(line) + 1
+        return line.rstrip()
+
+    def _file_state(self):
         """
-        Checks that file was rotated
-        :return: bool
+        Checks if the file is still there and if it is the same file
+
+        While the file is missing (removed by logrotate, not created by nginx yet) it is
+        checked with exponential backoff - after missing_min_delay seconds, then after twice more
+        and so on up to missing_max_delay seconds. Between checks it is considered missing without a stat.
+
+        :return: str PRESENT, ROTATED or MISSING
         """
-        # wait for new file
-        new_inode = self._inode
-        while True:
-            try:
-                new_inode = stat(self.filename).st_ino
-            except:
-                pass
+        now = time.time()
+        if self.missing_since is not None and now < self._next_check:
+            return MISSING
+
+        try:
+            inode = os.stat(self.filename).st_ino
+        except OSError:
+            if self.missing_since is None:
+                self.missing_since = now
+                self._missing_delay = self.missing_min_delay
             else:
-                break
-        return new_inode != self._inode
+                self._missing_delay = min(self._missing_delay * 2, self.missing_max_delay)
+            self._next_check = now + self._missing_delay
+            return MISSING
+
+        self.missing_since = None
+        return ROTATED if inode != self._inode else PRESENT
 
     def __next__(self):
         """`__next__` is the Python 3 version of `next`"""
@@ -77,35 +264,394 @@ class FileTail(object):
         """
         return [line for line in self]
 
-    def _is_closed(self):
-        if not self._fh:
-            return True
-        return self._fh.closed
+    def readchunks(self, size=CHUNK_SIZE):
+        """
+        Read in all unread lines in blocks of about `size` bytes.
+
+        Every chunk ends on a line boundary: a partial trailing line is left
+        unread until nginx finishes writing it, and a line longer than `size`
+        is accumulated until its newline is seen. If the caller stops iterating,
+        the next call continues right after the last returned chunk.
+
+        :param size: int bytes to read at once
+        :return: generator of str chunks of newline separated lines
+        """
+        fd = self._filedescriptor()
+        if fd is None:
+            self.caught_up = True
+            return
+
+        self.caught_up = False
+        position = self._offset
+        pending = ''
+        if not self.gzip and (self._lines or self._pending):
+            # lines were read by next() but not returned, read them again
+            self._lines, self._pending = [], ''
+            os.lseek(fd, self._offset, os.SEEK_SET)
+
+        try:
+            if self.gzip:
+                # decompressed data can't be read again, continue with what was left by next()
+                pending, self._pending = self._pending, ''
+                if self._lines:
+                    lines, self._lines = self._lines, []
+                    lines.reverse()
+                    yield '\n'.join(lines) + '\n'
+
+            while True:
+                data, length = self._read(fd, size)
+                if not length:
+                    if not self._rotated:
+                        self.caught_up = True
+                        break
+
+                    if pending:
+                        # the old file is complete, so is its last line
+                        self._offset = position
+                        yield pending + '\n'
+                        pending = ''
+
+                    fd = self._next_file()
+                    if fd is None:
+                        self.caught_up = True
+                        break
+                    position = 0
+                    continue
+                position += length
+
+                if pending:
+                    data = pending + data
+                    pending = ''
+
+                end = data.rfind('\n')
+                if end == -1:
+                    pending = data
+                    continue
+
+                if end < len(data) - 1:
+                    pending = data[end + 1:]
+                    data = data[:end + 1]
+
+                # a chunk counts as read once it is returned, so a caller may stop at any chunk
+                self._offset = position if self.gzip else position - len(pending)
+                yield data
+        finally:
+            if self.gzip:
+                # everything read is in the decompressor already, keep the incomplete line
+                self._offset, self._pending = position, pending
+            # do not consume an incomplete line or chunks left after the caller stopped
+            self._end_pass()
+
+    def skip_to_end(self):
+        """
+        Moves the offset to the end of the file without reading it
+
+        :return: int number of skipped bytes
+        """
+        fd = self._filedescriptor()
+        if fd is None:
+            self.caught_up = True
+            return 0
+
+        skipped = 0
+        if self._rotated:
+            skipped += max(os.fstat(fd).st_size - self._offset, 0)
+            fd = self._next_file()
+
+        if fd is not None:
+            size = os.fstat(fd).st_size
+            skipped += max(size - self._offset, 0)
+            self._offset = size
+            self._restart_stream()
+
+        self._end_pass()
+        self.caught_up = True
+        return skipped
+
+    def backlog(self):
+        """
+        Returns number of bytes written to the file but not read yet
+
+        :return: int bytes
+        """
+        try:
+            file_stat = os.stat(self.filename)
+        except OSError:
+            return 0
+
+        if file_stat.st_ino != self._inode or file_stat.st_size < self._offset:
+            # rotated or truncated, the new file will be read from the beginning
+            return file_stat.st_size
+        return file_stat.st_size - self._offset
 
-    def _filehandle(self):
+    def _filedescriptor(self):
         """
-        Return a filehandle to the file being tailed, with the position set
-        to the current offset.
+        Return a file descriptor of the file being tailed.
+        At the start of a pass checks for rotation and sets the position to the current offset.
+        If the file is missing, the old one is read if it is still open.
+
+        :return: int file descriptor or None if there is nothing to read
         """
-        file_was_rotated = self._file_was_rotated()
+        if self._reading:
+            return self._fd
+
+        if self._take_over_pending:
+            self._take_over()
+
+        state = self._file_state()
 
-        if not self._fh or self._is_closed() or file_was_rotated:
-            if not self._is_closed():
-                self._fh.close()
+        if self._fd is None:
+            # closed by close(), the old file is lost if it was rotated
+            if state == MISSING:
+                return None
 
-            if file_was_rotated:
-                self._inode = stat(self.filename).st_ino
+            try:
+                self._fd = os.open(self.filename, os.O_RDONLY)
+            except OSError:
+                return None
+
+            if state == ROTATED:
+                self._inode = os.fstat(self._fd).st_ino
                 self._offset = 0
+                self._restart_stream()
+        elif state == ROTATED:
+            # nginx might have written more to the old file before it reopened logs,
+            # read it to the end first, see _next_file()
+            self._rotated = True
 
-            self._fh = open(self.filename, "r")
-            self._fh.seek(self._offset)
-        return self._fh
+        if os.fstat(self._fd).st_size < self._offset:
+            # copytruncate: the file was copied and truncated in place, start from the beginning of it
+            self._offset = 0
+            self._restart_stream()
 
-    def _update_offset(self):
-        self._offset = self._filehandle().tell()
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        self._reading = True
+        return self._fd
 
-    def _get_next_line(self):
-        line = self._filehandle().readline()
-        if not line:
-            raise StopIteration
-        return line.rstrip()
+    def _next_file(self):
+        """
+        Switches from the end of the rotated file to the beginning of the new one
+
+        :return: int file descriptor or None if there is no new file yet
+        """
+        os.close(self._fd)
+        self._fd = None
+        self._rotated = False
+        self._offset = 0
+        self._restart_stream()
+
+        try:
+            self._fd = os.open(self.filename, os.O_RDONLY)
+        except OSError:
+            # the next pass will wait for it
+            self._reading = False
+            return None
+
+        self._inode = os.fstat(self._fd).st_ino
+        return self._fd
+
+    def _read_lines(self):
+        """
+        Reads blocks until at least one complete line is found
+
+        :return: bool False if the end of the file is reached
+        """
+        fd = self._filedescriptor()
+        if fd is None:
+            return False
+
+        while True:
+            data, length = self._read(fd, CHUNK_SIZE)
+            if not length:
+                if not self._rotated:
+                    return False
+
+                if self._pending:
+                    # the old file is complete, so is its last line
+                    self._lines, self._pending = [self._pending], ''
+                    return True
+
+                fd = self._next_file()
+                if fd is None:
+                    return False
+                continue
+
+            if self.gzip:
+                self._offset += length
+
+            if self._pending:
+                data = self._pending + data
+
+            lines = data.split('\n')
+            self._pending = lines.pop()
+            if lines:
+                lines.reverse()
+                self._lines = lines
+                return True
+
+    def _read(self, fd, size):
+        """
+        Reads a block of the file, decompresses it if needed
+
+        :param fd: int file descriptor
+        :param size: int bytes to read
+        :return: (str data, int number of bytes read from the file)
+        """
+        data = os.read(fd, size)
+        self.bytes_read += len(data)
+        if self._stream is None or not data:
+            return data, len(data)
+        return self._stream.decompress(data), len(data)
+
+    def _restart_stream(self):
+        """
+        Forgets the state of decompression when the file is read from another place
+        """
+        if self._stream is not None:
+            self._stream = GzipStream()
+            self._lines, self._pending = [], ''
+
+    def _end_pass(self):
+        """
+        Forgets everything read after the offset, the next pass starts from it
+        Lines decompressed from a gzip file are kept, the offset is after them already
+        """
+        if not self.gzip:
+            self._lines, self._pending = [], ''
+        self._reading = False
+
+
+class TailCheckpoints(object):
+    """
+    Inodes and offsets of all tailed files, saved to a small state file
+
+    They are updated in memory when log collectors stop (for example on nginx reload)
+    and written every `interval` seconds and on agent shutdown, so reading can resume after restarts.
+    """
+
+    interval = 60
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tails = weakref.WeakSet()
+        self.checkpoints = None  # filename -> [inode, offset], loaded on the first use
+        self.last_save = time.time()
+        self.save_failed = False  # a failure is reported once, not every interval
+
+    def register(self, tail):
+        self.tails.add(tail)
+
+    def update(self, tail):
+        """
+        Remembers the current position of the tail
+
+        :param tail: FileTail
+        """
+        self._load()
+        self.checkpoints[tail.filename] = [tail._inode, tail._offset]
+
+    def release(self, tail):
+        """
+        Remembers the last position of the tail that is not going to be read anymore
+
+        :param tail: FileTail
+        """
+        self.update(tail)
+        self.tails.discard(tail)
+
+    def reading(self, filename):
+        """
+        :param filename: str path to the file
+        :return: bool True if a live tail reads the file
+        """
+        return any(tail.filename == filename for tail in list(self.tails))
+
+    def position(self, filename, exclude=None):
+        """
+        Returns the current position of a live tail of the file or the checkpoint if there is no live one
+
+        :param filename: str path to the file
+        :param exclude: FileTail to ignore
+        :return: (inode, offset) or None
+        """
+        for tail in list(self.tails):
+            if tail.filename == filename and tail is not exclude:
+                return tail._inode, tail._offset
+        return self.get(filename)
+
+    def get(self, filename):
+        """
+        :param filename: str path to the file
+        :return: (inode, offset) or None
+        """
+        self._load()
+        checkpoint = self.checkpoints.get(filename)
+        return tuple(checkpoint) if checkpoint else None
+
+    def save(self, force=False):
+        """
+        Writes positions of all live tails to the state file, not more often than once in `interval` seconds
+
+        :param force: bool write it right now
+        """
+        now = time.time()
+        if not force and now < self.last_save + self.interval:
+            return
+        self.last_save = now
+
+        for tail in list(self.tails):
+            self.update(tail)
+
+        path = self._path()
+        if not path:
+            return
+
+        try:
+            temp_path = '%s.tmp' % path
+            with open(temp_path, 'w') as f:
+                f.write(ujson.encode(self.checkpoints))
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            if not self.save_failed:
+                context.log.warning(
+                    'failed to save tail checkpoints to %s due to %s, logs will be read from the end after restart' %
+                    (path, e.__class__.__name__)
+                )
+                context.log.debug('additional info:', exc_info=True)
+            self.save_failed = True
+        else:
+            self.save_failed = False
+
+    def _path(self):
+        """
+        :return: str path to the state file, next to the pid file unless it is set in the config
+        """
+        if self.path:
+            return self.path
+
+        daemon_config = context.app_config['daemon']
+        if daemon_config.get('tail_checkpoints'):
+            return daemon_config['tail_checkpoints']
+
+        pid_file = daemon_config.get('pid')
+        if pid_file:
+            return os.path.join(os.path.dirname(pid_file), 'amplify_agent.tails')
+
+    def _load(self):
+        if self.checkpoints is not None:
+            return
+
+        self.checkpoints = {}
+        path = self._path()
+        if not path or not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                self.checkpoints = ujson.decode(f.read())
+        except (IOError, ValueError) as e:
+            context.log.error('failed to load tail checkpoints from %s due to %s' % (path, e.__class__.__name__))
+            context.log.debug('additional info:', exc_info=True)
+
+
+tail_checkpoints = TailCheckpoints()
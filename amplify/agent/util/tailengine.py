@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from collections import OrderedDict
+from threading import current_thread
+
+from amplify.agent.context import context
+from amplify.agent.util.threads import spawn
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class TailEngine(object):
+    """
+    Reads all registered log files in one loop instead of a greenlet per log collector.
+
+    Every cycle the engine checks how many bytes each file has behind EOF and lets the collectors
+    read and parse their files starting from the most loaded one. Idle files are not opened,
+    their collectors only send zero counters. Missing files are looked for, so collectors can tell about them. Not more than `max_open_files` files are kept open,
+    the least recently read one is closed when another one has to be opened.
+    """
+
+    short_name = 'tail_engine'
+
+    def __init__(self, max_open_files=256, interval=10):
+        self.max_open_files = max_open_files
+        self.default_interval = self.interval = interval
+        self.collectors = []
+        self.open_tails = OrderedDict()  # FileTail -> None, the most recently read one is the last
+        self.thread = None
+
+    def register(self, collector):
+        """
+        Starts reading the log of the collector
+        The collector should have `tail` (FileTail), `changed` (bool) and `collect()`
+
+        :param collector: log collector
+        """
+        self.collectors.append(collector)
+        collector.tail.close()  # it is opened again when there is something to read
+        self.update_interval()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = spawn(self.run)
+
+    def unregister(self, collector):
+        """
+        Stops reading the log of the collector and closes it
+
+        :param collector: log collector
+        """
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+            self.update_interval()
+        self.release(collector.tail)
+
+    def update_interval(self):
+        """
+        Cycles run as often as the most frequent registered collector wants
+        """
+        intervals = [c.interval for c in self.collectors if c.interval]
+        self.interval = min(intervals) if intervals else self.default_interval
+
+    def run(self):
+        current_thread().name = self.short_name
+        context.setup_thread_id()
+
+        while True:
+            context.inc_action_id()
+            try:
+                self.cycle()
+            except:
+                context.log.error('%s failed' % self.short_name, exc_info=True)
+            time.sleep(self.interval)
+
+    def cycle(self):
+        """
+        Runs collectors of all registered logs once, the ones with more unread bytes go first
+        """
+        ready = []
+        for collector in self.collectors:
+            if collector.object.running:
+                ready.append((collector.tail.backlog(), collector))
+        ready.sort(key=lambda item: item[0], reverse=True)
+
+        for backlog, collector in ready:
+            # a pass over a missing file (or the one that was missing) finds out if it's back
+            tail = collector.tail
+            collector.changed = backlog > 0 or tail.missing_since is not None or not os.path.exists(tail.filename)
+            if collector.changed:
+                self.acquire(collector.tail)
+
+            try:
+                collector._collect()
+            except Exception as e:
+                exception_name = e.__class__.__name__
+                context.log.error('failed to collect %s due to %s' % (collector.filename, exception_name))
+                context.log.debug('additional info:', exc_info=True)
+
+    def acquire(self, tail):
+        """
+        Marks the file as the most recently read one and closes the least recently read one if there are too many
+
+        :param tail: FileTail
+        """
+        if tail in self.open_tails:
+            del self.open_tails[tail]
+        else:
+            while len(self.open_tails) >= self.max_open_files:
+                least_recent_tail, _ = self.open_tails.popitem(last=False)
+                least_recent_tail.close()
+        self.open_tails[tail] = None
+
+    def release(self, tail):
+        """
+        Closes the file
+
+        :param tail: FileTail
+        """
+        if tail in self.open_tails:
+            del self.open_tails[tail]
+        tail.close()
+
+
+tail_engine = TailEngine()
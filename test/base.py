@@ -138,4 +138,7 @@ def nginx_plus_installed():
 
 nginx_plus_test = pytest.mark.skipif(not nginx_plus_installed(), reason='This is a test for nginx+')
 future_test = pytest.mark.skipif(1 > 0, reason='This test will be written in future')
+performance_test = pytest.mark.skipif(
+    not os.environ.get('AMPLIFY_PERFORMANCE_TESTS'), reason='Set AMPLIFY_PERFORMANCE_TESTS=1 to run performance tests'
+)
 
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import resource
+
+from hamcrest import *
+
+from test.base import BaseTestCase, performance_test
+from amplify.agent.context import context
+from amplify.agent.configd import ConfigdClient
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class FakeObject(object):
+    definition = {'type': 'nginx', 'local_id': 'test'}
+
+
+class LegacyConfigdClient(ConfigdClient):
+    """
+    Client that copies the payload before sending it
+    """
+    def flush(self):
+        if not self.current:
+            return
+
+        delivery = copy.deepcopy(self.current)
+        self.current = {}
+        return {
+            'object': self.object.definition,
+            'config': delivery,
+            'agent_version': self.context.version
+        }
+
+
+def large_payload(files=2000, lines=50):
+    """
+    :return: dict like the one nginx config collector uploads for a big config
+    """
+    tree = {}
+    for i in xrange(files):
+        tree['/etc/nginx/sites-enabled/site%s.conf' % i] = [
+            {'server_name': 'site%s-%s.example.com' % (i, j), 'root': '/var/www/%s/%s' % (i, j)}
+            for j in xrange(lines)
+        ]
+    return {'root': '/etc/nginx/nginx.conf', 'tree': tree, 'files': dict((name, {}) for name in tree)}
+
+
+def flush_peak_rss(client_class):
+    """
+    Flushes a large config in a forked process
+
+    :return: int increase of peak RSS (kilobytes) caused by flush
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            client = client_class(object=FakeObject())
+            client.config(payload=large_payload(), checksum='0')
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            client.flush()
+            os.write(write_end, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+        finally:
+            os._exit(0)
+
+    os.close(write_end)
+    result = os.read(read_end, 64)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+class ConfigdClientTestCase(BaseTestCase):
+    def test_flush(self):
+        payload = large_payload(files=2, lines=2)
+        client = ConfigdClient(object=FakeObject())
+        client.config(payload=payload, checksum='123')
+
+        flushed = client.flush()
+        assert_that(flushed['config']['data'], is_(payload))
+        assert_that(flushed['config']['checksum'], equal_to('123'))
+        assert_that(client.current, equal_to({}))
+        assert_that(client.flush(), equal_to(None))
+
+
+@performance_test
+class ConfigdClientPerformanceTestCase(BaseTestCase):
+    def test_peak_rss(self):
+        legacy_rss, swap_rss = flush_peak_rss(LegacyConfigdClient), flush_peak_rss(ConfigdClient)
+        context.default_log.info('peak RSS growth on flush: deepcopy %sKB, swap %sKB' % (legacy_rss, swap_rss))
+        assert_that(legacy_rss, greater_than(10 * 1024))
+        assert_that(swap_rss, less_than(1024))
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import os
+import time
+import zlib
+import hashlib
+
 from hamcrest import *
 from collections import defaultdict
 
-from test.base import NginxCollectorTestCase
+from amplify.agent.context import context
+from test.base import NginxCollectorTestCase, performance_test
 from amplify.agent.containers.nginx.log.access import NginxAccessLogParser
-from amplify.agent.containers.nginx.collectors.accesslog import NginxAccessLogsCollector
+from amplify.agent.containers.nginx.collectors.accesslog import NginxAccessLogsCollector, log_stats
+from amplify.agent.util.inotify import FileWatcher
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -23,6 +30,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.http_method(NginxAccessLogParser().parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -38,6 +46,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.http_method(NginxAccessLogParser().parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -54,6 +63,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.http_status(NginxAccessLogParser().parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -74,6 +84,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -106,6 +117,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -131,6 +143,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -161,6 +174,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -194,6 +208,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -234,6 +249,7 @@ class LogsPerMethodTestCase(NginxCollectorTestCase):
         # run single method
         collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
         collector.upstreams(NginxAccessLogParser(log_format).parse(line))
+        collector.flush_metrics()
 
         # check
         metrics = self.fake_object.statsd.current
@@ -506,3 +522,353 @@ class LogsOverallTestCase(NginxCollectorTestCase):
             else:
                 if counter_key not in collector.parser.request_variables:
                     assert_that(counter, not_(has_key('C|nginx.%s' % counter_name)))
+
+    def test_parsed_variables(self):
+        collector = NginxAccessLogsCollector(object=self.fake_object, tail=[])
+        parser = collector.parser
+
+        assert_that(parser.keys, has_item('http_user_agent'))
+        assert_that(parser.captured_keys, not_(has_item('http_user_agent')))
+        assert_that(parser.captured_keys, not_(has_item('remote_addr')))
+
+        # every counter variable is captured (or derived from $request)
+        for counter_key in collector.counters.itervalues():
+            if counter_key not in parser.request_variables:
+                assert_that(parser.captures(counter_key), equal_to(True))
+
+
+class SlotAggregationTestCase(NginxCollectorTestCase):
+    log_format = '$remote_addr - $remote_user [$time_local] ' + \
+                 '"$request" $status $body_bytes_sent "$http_referer" "$http_user_agent" ' + \
+                 'rt=$request_time ut="$upstream_response_time" cs=$upstream_cache_status'
+
+    line = '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/%s" 200 11078 ' + \
+           '"http://www.rambler.ru/" "Mozilla/5.0 (Windows; U; Windows NT 5.1" rt=0.010 ut="%s" cs=%s'
+
+    def test_single_bulk_call(self):
+        lines = [self.line % ('1.1', '0.005', 'MISS')] * 10 + [self.line % ('1.1', '-', 'HIT')] * 10
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=self.log_format, tail=lines)
+
+        calls = defaultdict(int)
+        for name in ('incr', 'timer', 'average', 'bulk'):
+            def counted(*args, **kwargs):
+                calls[counted.name] += 1
+                return counted.method(*args, **kwargs)
+            counted.name, counted.method = name, getattr(collector.statsd, name)
+            setattr(collector.statsd, name, counted)
+
+        collector.collect()
+        assert_that(calls, equal_to({'bulk': 1}))
+
+        metrics = self.fake_object.statsd.current
+        assert_that(metrics['counter']['nginx.http.method.get'][0][1], equal_to(20))
+        assert_that(metrics['counter']['nginx.cache.miss'][0][1], equal_to(10))
+        assert_that(metrics['counter']['nginx.cache.hit'][0][1], equal_to(10))
+        assert_that(metrics['counter']['nginx.upstream.request.count'][0][1], equal_to(20))
+        assert_that(metrics['counter']['nginx.http.status.5xx'][0][1], equal_to(0))
+        assert_that(metrics['timer']['nginx.http.request.time'], has_length(20))
+        assert_that(metrics['timer']['nginx.upstream.response.time'], equal_to([0.005] * 10))
+
+    def test_unexpected_values(self):
+        lines = [self.line % ('3.0', '-', 'SCARCE')]
+        collector = NginxAccessLogsCollector(object=self.fake_object, log_format=self.log_format, tail=lines)
+        slots = len(collector.counter_names)
+
+        collector.collect()
+        counters = self.fake_object.statsd.current['counter']
+        assert_that(counters, has_key('nginx.http.v3_0'))
+        assert_that(counters, has_key('nginx.cache.scarce'))
+
+        # slots for unexpected values are dropped after flush
+        assert_that(collector.counter_names, has_length(slots))
+        assert_that(collector.counter_slots, not_(has_key('cache.scarce')))
+
+
+@performance_test
+class SlotAggregationPerformanceTestCase(NginxCollectorTestCase):
+    def test_throughput(self):
+        class PerLineStatsdCollector(NginxAccessLogsCollector):
+            """
+            Sends every value to statsd right away, like collectors did before slot aggregation
+            """
+            def count(self, slot, value=1):
+                self.statsd.incr(self.counter_names[slot], value)
+
+            def flush_metrics(self):
+                for (metric_type, name), values in zip(self.sample_names, self.sample_values):
+                    for value in values:
+                        getattr(self.statsd, metric_type)(name, value)
+                self.sample_values = [[] for _ in self.sample_names]
+
+        # 100k lines, most of them are cache hits without upstream
+        lines = [
+            SlotAggregationTestCase.line % ('1.1', '0.005' if i % 5 == 0 else '-', 'MISS' if i % 5 == 0 else 'HIT')
+            for i in xrange(100000)
+        ]
+
+        speed = []
+        for cls in (PerLineStatsdCollector, NginxAccessLogsCollector):
+            collector = cls(object=self.fake_object, log_format=SlotAggregationTestCase.log_format, tail=lines)
+            start = time.time()
+            collector.collect()
+            speed.append(len(lines) / (time.time() - start))
+            self.fake_object.statsd.flush()
+
+        per_line_speed, slots_speed = speed
+        context.default_log.info('per line statsd %d lines/s, slots %d lines/s' % (per_line_speed, slots_speed))
+        assert_that(slots_speed, greater_than(per_line_speed * 1.2))
+
+
+class SamplingTestCase(NginxCollectorTestCase):
+    def test_sampling(self):
+        lines = [
+            SlotAggregationTestCase.line % ('1.1', '0.005' if i % 2 else '-', 'MISS' if i % 2 else 'HIT')
+            for i in xrange(100)
+        ]
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, tail=lines, sampling=True
+        )
+        collector.sampling_threshold = 10
+        collector.interval = 1
+
+        # first pass - no idea about the rate yet
+        collector.collect()
+        metrics = self.fake_object.statsd.flush()['metrics']
+        assert_that(metrics['counter']['C|nginx.http.method.get'][0][1], equal_to(100))
+        assert_that(metrics['timer']['C|nginx.http.request.time.count'][0][1], equal_to(100))
+        assert_that(metrics['gauge']['G|nginx.http.request.sampling_ratio'][0][1], equal_to(1.0))
+
+        # second pass - every 10th line is parsed, counters are scaled back
+        collector.collect()
+        metrics = self.fake_object.statsd.flush()['metrics']
+        assert_that(collector.sampling_step, equal_to(10))
+        assert_that(metrics['counter']['C|nginx.http.method.get'][0][1], equal_to(100))
+        assert_that(metrics['counter']['C|nginx.http.request.body_bytes_sent'][0][1], equal_to(100 * 11078))
+        assert_that(metrics['timer']['C|nginx.http.request.time.count'][0][1], equal_to(10))
+        assert_that(metrics['gauge']['G|nginx.http.request.sampling_ratio'][0][1], equal_to(0.1))
+
+    def test_short_passes(self):
+        lines = [SlotAggregationTestCase.line % ('1.1', '-', 'HIT')] * 100
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, tail=lines, sampling=True
+        )
+        collector.sampling_threshold = 10
+        collector.interval = 10
+
+        # 100 lines per interval are 10 lines per second - no sampling
+        collector.collect()
+        assert_that(collector.line_rate, equal_to(10))
+
+        # the watcher started the next pass a second later - it's 100 lines per second
+        collector.previous_pass = time.time() - 1
+        collector.collect()
+        assert_that(collector.sampling_step, equal_to(1))
+        assert_that(collector.line_rate, close_to(100, 1))
+
+        collector.previous_pass = time.time() - 1
+        collector.collect()
+        assert_that(collector.sampling_step, equal_to(10))
+
+    def test_disabled(self):
+        lines = [SlotAggregationTestCase.line % ('1.1', '-', 'HIT')] * 100
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, tail=lines
+        )
+        collector.sampling_threshold = 10
+        collector.interval = 1
+
+        for _ in xrange(2):
+            collector.collect()
+            assert_that(collector.sampling_step, equal_to(1))
+
+        metrics = self.fake_object.statsd.flush()['metrics']
+        assert_that(metrics['counter']['C|nginx.http.method.get'][0][1], equal_to(200))
+        assert_that(metrics, not_(has_key('gauge')))
+
+
+class LogFileTestCase(NginxCollectorTestCase):
+    """
+    Creates an empty log file test_log for every test and removes it afterwards
+    """
+    test_log = None
+
+    def setup_method(self, method):
+        super(LogFileTestCase, self).setup_method(method)
+        open(self.test_log, 'w').close()
+
+    def teardown_method(self, method):
+        if os.path.exists(self.test_log):
+            os.remove(self.test_log)
+        super(LogFileTestCase, self).teardown_method(method)
+
+
+class BudgetTestCase(LogFileTestCase):
+    test_log = 'log/access_budget.log'
+
+    def test_line_budget(self):
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, filename=self.test_log,
+            line_budget=1
+        )
+
+        # about 3MB, so several chunks
+        line = SlotAggregationTestCase.line % ('1.1', '-', 'HIT') + '\n'
+        lines = 3 * 1024 * 1024 / len(line)
+        with open(self.test_log, 'a') as f:
+            f.write(line * lines)
+
+        # first pass stops after the first chunk
+        collector.collect()
+        first = self.fake_object.statsd.flush()['metrics']['counter']['C|nginx.http.method.get'][0][1]
+        assert_that(first, less_than(lines))
+
+        filename, lag_bytes, lines_per_second, skipped_bytes = log_stats[collector]
+        assert_that(lag_bytes, equal_to((lines - first) * len(line)))
+        assert_that(lines_per_second, greater_than(0))
+
+        # the rest is read without a budget
+        collector.line_budget = None
+        collector.collect()
+        second = self.fake_object.statsd.flush()['metrics']['counter']['C|nginx.http.method.get'][0][1]
+        assert_that(first + second, equal_to(lines))
+        assert_that(log_stats[collector][1], equal_to(0))
+
+    def test_catchup_skip(self):
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, filename=self.test_log,
+            catchup_policy='skip', catchup_threshold=1024
+        )
+        line = SlotAggregationTestCase.line % ('1.1', '-', 'HIT') + '\n'
+        with open(self.test_log, 'a') as f:
+            f.write(line * 100)
+
+        collector.collect()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.status.2xx'][0][1], equal_to(0))
+        assert_that(log_stats[collector][3], equal_to(100 * len(line)))
+
+        # under the threshold it is read as usual
+        with open(self.test_log, 'a') as f:
+            f.write(line * 2)
+
+        collector.collect()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.method.get'][0][1], equal_to(2))
+
+    def test_catchup_read(self):
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, filename=self.test_log,
+            catchup_policy='read', catchup_threshold=1024
+        )
+        line = SlotAggregationTestCase.line % ('1.1', '-', 'HIT') + '\n'
+        with open(self.test_log, 'a') as f:
+            f.write(line * 100)
+
+        collector.collect()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.method.get'][0][1], equal_to(100))
+        assert_that(log_stats[collector][1], equal_to(0))
+
+    def test_time_budget(self):
+        lines = [SlotAggregationTestCase.line % ('1.1', '-', 'HIT')] * 10
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, tail=lines, time_budget=1
+        )
+        assert_that(collector.budget_exhausted(time.time(), 10), equal_to(False))
+        assert_that(collector.budget_exhausted(time.time() - 2, 10), equal_to(True))
+
+        collector.collect()
+        assert_that(log_stats[collector][1], equal_to(0))
+
+
+class GzipSamplingTestCase(LogFileTestCase):
+    test_log = 'log/access_sampling.log.gz'
+
+    def write_lines(self, first, number):
+        lines = ''.join(
+            SlotAggregationTestCase.line % ('1.1', hashlib.md5(str(i)).hexdigest(), 'MISS') + '\n'
+            for i in xrange(first, first + number)
+        )
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        with open(self.test_log, 'ab') as f:
+            f.write(compressor.compress(lines) + compressor.flush())
+
+    def test_compressed_backlog(self):
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, filename=self.test_log,
+            sampling=True, gzip=True, interval=10
+        )
+        collector.sampling_threshold = 100
+
+        self.write_lines(0, 100)
+        collector.collect()
+        assert_that(collector.sampling_step, equal_to(1))
+
+        # 1000 lines written in a second, their backlog is measured in compressed bytes
+        self.write_lines(100, 1000)
+        collector.previous_pass = time.time() - 1
+        collector.collect()
+        assert_that(collector.sampling_step, greater_than(5))
+        assert_that(collector.sampling_step, less_than(20))
+
+
+class UnchangedLogTestCase(LogFileTestCase):
+    test_log = 'log/access_unchanged.log'
+
+    def test_unchanged(self):
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, filename=self.test_log
+        )
+        with open(self.test_log, 'a') as f:
+            f.write(SlotAggregationTestCase.line % ('1.1', '-', 'HIT') + '\n')
+
+        # the watcher saw no changes - only zero counters are sent
+        collector.changed = False
+        collector.collect()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.status.2xx'][0][1], equal_to(0))
+
+        collector.changed = True
+        collector.collect()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.status.2xx'][0][1], equal_to(1))
+
+    def test_backlog(self):
+        collector = NginxAccessLogsCollector(
+            object=self.fake_object, log_format=SlotAggregationTestCase.log_format, filename=self.test_log,
+            interval=0.1
+        )
+        line = SlotAggregationTestCase.line % ('1.1', '-', 'HIT')
+        with open(self.test_log, 'a') as f:
+            f.write(line + '\n' + line + '\n')
+        collector.watcher = FileWatcher(self.test_log)
+
+        # the previous pass stopped after the first line, the watcher won't report the second one
+        chunks = collector.tail.readchunks(size=len(line) + 1)
+        next(chunks)
+        chunks.close()
+        collector._sleep()
+        assert_that(collector.changed, equal_to(True))
+
+        collector.collect()
+        collector._sleep()
+        assert_that(collector.changed, equal_to(False))
+
+
+class MissingLogTestCase(LogFileTestCase):
+    test_log = 'log/access_missing.log'
+
+    def test_events(self):
+        collector = NginxAccessLogsCollector(object=self.fake_object, filename=self.test_log)
+        os.remove(self.test_log)
+
+        collector.collect()
+        messages = [event.message for event in self.fake_object.eventd.current.values()]
+        assert_that(messages, has_item('nginx log %s is missing' % self.test_log))
+
+        open(self.test_log, 'w').close()
+        collector.tail._next_check = 0
+
+        collector.collect()
+        messages = [event.message for event in self.fake_object.eventd.current.values()]
+        assert_that(messages, has_item('nginx log %s is found again' % self.test_log))
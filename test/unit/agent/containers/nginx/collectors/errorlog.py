@@ -3,7 +3,7 @@ from hamcrest import *
 
 from test.base import NginxCollectorTestCase
 from amplify.agent.containers.nginx.log.error import NginxErrorLogParser
-from amplify.agent.containers.nginx.collectors.errorlog import NginxErrorLogsCollector
+from amplify.agent.containers.nginx.collectors.errorlog import NginxErrorLogsCollector, CappedCounters
 
 
 __author__ = "Mike Belov"
@@ -56,3 +56,100 @@ class LogsOverallTestCase(NginxCollectorTestCase):
         # check zero values
         for error_counter in collector.counters:
             assert_that(counter, has_key('C|nginx.%s' % error_counter))
+
+    def test_failures_by_upstream(self):
+        line = '2015/07/14 08:42:57 [error] 28386#28386: *38699 connect() failed (111: Connection refused) ' + \
+               'while connecting to upstream, client: 127.0.0.1, server: %s, request: "GET / HTTP/1.1", ' + \
+               'upstream: "http://%s/index.html", host: "localhost"'
+        lines = [
+            line % ('example.com', '10.0.0.1:80'),
+            line % ('example.com', '10.0.0.1:80'),
+            line % ('example.org', '10.0.0.2:80'),
+            line % ('example.org', '10.0.0.3:80'),
+        ]
+
+        collector = NginxErrorLogsCollector(level='error', object=self.fake_object, tail=lines, max_failure_names=2)
+        collector.collect()
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|nginx.upstream.request.failed'][0][1], equal_to(4))
+        assert_that(counter['C|nginx.upstream.failed|http://10.0.0.1:80'][0][1], equal_to(2))
+        assert_that(counter['C|nginx.upstream.failed|http://10.0.0.2:80'][0][1], equal_to(1))
+        assert_that(counter['C|nginx.upstream.failed|__other__'][0][1], equal_to(1))
+        assert_that(counter['C|nginx.server.upstream.failed|example.com'][0][1], equal_to(2))
+        assert_that(counter['C|nginx.server.upstream.failed|example.org'][0][1], equal_to(2))
+
+
+    def test_templates(self):
+        lines = [
+            '2015/07/14 08:42:57 [alert] 28386#28386: worker process 1234 exited on signal 9',
+            '2015/07/14 08:42:58 [alert] 28386#28386: worker process 1235 exited on signal 9',
+            '2015/07/14 08:42:59 [info] 28386#28386: *38706 client 10.196.158.41 closed keepalive connection',
+        ]
+
+        collector = NginxErrorLogsCollector(
+            filename='error.log', level='info', object=self.fake_object, tail=lines, top_templates=1
+        )
+        collector.collect()
+
+        events = self.fake_object.eventd.flush()['events']
+        assert_that(events, has_length(1))
+        assert_that(events[0]['message'], equal_to(
+            'nginx error log error.log: [alert] worker process <number> exited on signal <number>'
+        ))
+        assert_that(events[0]['counter'], equal_to(2))
+
+
+    def test_skip_levels(self):
+        upstream_failed = '2015/07/14 08:42:57 [%s] 28386#28386: *38699 connect() failed (111: Connection ' + \
+                          'refused) while connecting to upstream, client: 127.0.0.1, server: localhost, ' + \
+                          'request: "GET / HTTP/1.1", upstream: "http://10.0.0.1:80/", host: "localhost"'
+        lines = [
+            upstream_failed % 'debug',
+            upstream_failed % 'debug',
+            upstream_failed % 'info',
+            upstream_failed % 'error',
+            'garbage',
+        ]
+
+        collector = NginxErrorLogsCollector(level='debug', object=self.fake_object, tail=lines, min_level='notice')
+        collector.collect()
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter['C|nginx.upstream.request.failed'][0][1], equal_to(1))
+        assert_that(counter['C|nginx.errorlog.skipped|debug'][0][1], equal_to(2))
+        assert_that(counter['C|nginx.errorlog.skipped|info'][0][1], equal_to(1))
+        assert_that(counter, is_not(has_key('C|nginx.errorlog.skipped|notice')))
+
+    def test_unknown_min_level(self):
+        line = '2015/07/14 08:42:57 [info] 28386#28386: *38699 client 127.0.0.1 closed keepalive connection'
+
+        # an unknown level doesn't break the collector, nothing is skipped
+        collector = NginxErrorLogsCollector(level='debug', object=self.fake_object, tail=[line], min_level='Warn')
+        assert_that(collector.skipped_levels, equal_to(()))
+        collector.collect()
+
+        counter = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counter, is_not(has_key('C|nginx.errorlog.skipped|info')))
+
+
+class CappedCountersTestCase(NginxCollectorTestCase):
+
+    def test_overflow(self):
+        counters = CappedCounters(max_names=2)
+        for name in ('a', 'b', 'a', 'c', 'd'):
+            counters.incr(name)
+        assert_that(counters.flush(), equal_to([('a', 2), ('b', 1), ('__other__', 2)]))
+
+    def test_slots_are_freed(self):
+        counters = CappedCounters(max_names=2)
+        counters.incr('a')
+        counters.incr('b')
+        counters.flush()
+
+        # "b" was not seen in the last interval, "c" takes its slot
+        counters.incr('a')
+        counters.flush()
+        counters.incr('c')
+        assert_that(counters.flush(), equal_to([('c', 1)]))
+        assert_that(counters.values, has_length(1))
@@ -25,6 +25,7 @@ tabs_config = os.getcwd() + '/test/fixtures/nginx/custom/tabs.conf'
 fastcgi_config = os.getcwd() + '/test/fixtures/nginx/fastcgi/nginx.conf'
 json_config = os.getcwd() + '/test/fixtures/nginx/custom/json.conf'
 ssl_simple_config = os.getcwd() + '/test/fixtures/nginx/ssl/simple/nginx.conf'
+gzip_config = os.getcwd() + '/test/fixtures/nginx/custom/gzip.conf'
 
 
 class ConfigTestCase(BaseTestCase):
@@ -227,3 +228,21 @@ class ConfigTestCase(BaseTestCase):
         # check contents
         assert_that(ssl_certificates.keys()[0], ends_with('certs.d/example.com.crt'))
         assert_that(ssl_certificates.values()[0], has_item('names'))
+
+    def test_gzip_access_logs(self):
+        config = NginxConfig(gzip_config)
+        config.full_parse()
+
+        assert_that(config.access_logs, equal_to({
+            '/var/log/nginx/access.log': 'main',
+            '/var/log/nginx/access.log.gz': 'main',
+            '/var/log/nginx/default.log.gz': None,
+            '/var/log/nginx/broken.log.gz': None,
+        }))
+
+        # a bad level doesn't break parsing, the log is still read as gzip
+        assert_that(config.gzip_access_logs, equal_to({
+            '/var/log/nginx/access.log.gz': 4,
+            '/var/log/nginx/default.log.gz': 1,
+            '/var/log/nginx/broken.log.gz': 1,
+        }))
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+import time
+
 from hamcrest import *
 
-from amplify.agent.containers.nginx.log.access import NginxAccessLogParser
-from test.base import BaseTestCase
+from amplify.agent.context import context
+from amplify.agent.containers.nginx.collectors.accesslog import NginxAccessLogsCollector
+from amplify.agent.containers.nginx.log.access import (
+    NginxAccessLogParser, NginxAccessLogParserCache, REQUEST_RE, escape_char
+)
+from amplify.agent.util.escape import prep_raw
+from amplify.agent.util.tail import FileTail
+from test.base import BaseTestCase, performance_test
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -12,6 +22,156 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+class BaselineNginxAccessLogParser(object):
+    """
+    Parser as it was before variables got bounded by delimiters: a generic unanchored regex for every variable
+    Kept separate from NginxAccessLogParser, so the new parser is compared with the original behaviour
+    """
+    common_variables = NginxAccessLogParser.common_variables
+    default_variable = NginxAccessLogParser.default_variable
+    request_variables = NginxAccessLogParser.request_variables
+
+    def __init__(self, raw_format=None):
+        self.keys = []
+        self.regex_string = r''
+        current_key = None
+
+        def finalize_key():
+            key_without_dollar = current_key[1:]
+            self.keys.append(key_without_dollar)
+            rxp = self.common_variables.get(key_without_dollar, self.default_variable)[0]
+            var_count = self.keys.count(key_without_dollar)
+            if var_count > 1:
+                regex_var_name = '%s%s' % (key_without_dollar, var_count)
+            else:
+                regex_var_name = key_without_dollar
+            self.regex_string += '(?P<%s>%s)' % (regex_var_name, rxp)
+
+        for char in prep_raw(NginxAccessLogParser.combined_format if raw_format is None else raw_format):
+            if current_key:
+                if char.isalpha() or char == '_':
+                    current_key += char
+                    continue
+                finalize_key()
+                current_key = None
+
+            if char == '$':
+                current_key = char
+            else:
+                self.regex_string += escape_char(char)
+
+        if current_key:
+            finalize_key()
+
+        self.regex = re.compile(self.regex_string)
+
+    def parse(self, line):
+        result = {'malformed': False}
+
+        common = self.regex.match(line)
+        if common:
+            for key in self.keys:
+                func = self.common_variables.get(key, self.default_variable)[1]
+                try:
+                    value = func(common.group(key))
+                except ValueError:
+                    value = 0
+
+                if key.endswith('_time'):
+                    if value != '-':
+                        array_value = [x for x in map(float, value.replace(' ', '').split(',')) if x <= 10000000]
+                        if array_value:
+                            result[key] = array_value
+                else:
+                    result[key] = value
+
+        if 'request' in result:
+            req = REQUEST_RE.match(result['request'])
+            if req:
+                for req_key in self.request_variables.iterkeys():
+                    result[req_key] = req.group(req_key)
+            else:
+                result['malformed'] = True
+
+        return result
+
+
+sample_logs = (
+    (
+        None,
+        [
+            '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" '
+            '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"',
+            '10.0.0.1 - - [03/Jul/2015:04:46:18 -0400] "/xxx?q=1 GET POST" 400 173 "-" "-"',
+        ]
+    ),
+    (
+        '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+        '"$http_user_agent" "$http_x_forwarded_for" "$host" "$request_time" $gzip_ratio',
+        [
+            '141.101.234.201 - - [03/Jul/2015:10:52:33 +0300] "POST /wp-login.php HTTP/1.1" 200 3809 '
+            '"http://estevmeste.ru/wp-login.php" "Mozilla/5.0 (Windows NT 6.0; rv:34.0) Gecko/20100101 Firefox/34.0" '
+            '"-" "estevmeste.ru" "0.001" -',
+            '95.211.80.227 - - [03/Jul/2015:10:54:00 +0300] "GET /stub_status HTTP/2.1" 200 109 "-" '
+            '"cloudwatch-nginx-agent/1.0" "-" "defan.pp.ru" "0.134" -',
+        ]
+    ),
+    (
+        '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+        '"$http_user_agent" "$http_x_forwarded_for" "$upstream_addr" "$upstream_cache_status" '
+        '$connection/$connection_requests',
+        [
+            '217.15.195.202 - - [03/Jul/2015:11:12:53 +0300] "GET /gsat/9854/5231/14 HTTP/1.1" 200 11901 "-" '
+            '"tile-fetcher/0.1" "-" "173.194.32.133:80" "MISS" 62277/22',
+        ]
+    ),
+    (
+        '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+        '"$http_user_agent" rt=$request_time ut="$upstream_response_time" cs=$upstream_cache_status',
+        [
+            '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "http://www.rambler.ru/" '
+            '"Mozilla/5.0 (Windows; U; Windows NT 5.1" rt=0.010 ut="2.001, 0.345" cs=MISS',
+        ]
+    ),
+    (
+        '$remote_addr - [$time_local] $request_method $scheme "$request_uri"  $status $request_time '
+        '$body_bytes_sent  "$http_referer" "$http_user_agent" $host',
+        [
+            '85.25.210.234 - [17/Nov/2015:00:20:50 +0100] GET https "/robots.txt"  200 0.024 240  "-" '
+            '"Mozilla/5.0 (compatible; worldwebheritage.org/1.1; +crawl@worldwebheritage.org)" '
+            'www.nakupni-dum-praha.cz',
+        ]
+    ),
+    (
+        '$remote_addr - $remote_user [$time_local] "$request"  $status $body_bytes_sent "$http_referer" '
+        '"$http_user_agent" "$http_x_forwarded_for" rt=$request_time ua="$upstream_addr" '
+        'us="$upstream_status" ut="$upstream_response_time" cs=$upstream_cache_status',
+        [
+            '85.25.210.234 - - [22/Jan/2010:19:34:21 +0300] "GET / HTTP/2.0"  200 11078 "http://www.rambler.ru/" '
+            '"Mozilla/5.0 (Windows; U; Windows NT 5.1" "-" rt=0.024 ua="-" us="-" ut="0.024" cs="-"',
+        ]
+    ),
+    (
+        '"$time_local"\t"$remote_addr"\t"$http_host"\t"$request"\t"$status"\t"$body_bytes_sent\t'
+        '"$http_referer"\t"$http_user_agent"\t"$http_x_forwarded_for"',
+        [
+            '"27/Jan/2016:12:30:04 -0800"\t"173.186.135.227"\t"leete.ru"\t'
+            '"GET /img/_data/combined/j6vnc0.css HTTP/2.0"\t"200"\t"5909\t"https://leete.ru/img/"\t'
+            '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_3) AppleWebKit/537.36 (KHTML, like Gecko) '
+            'Chrome/47.0.2526.111 Safari/537.36"\t"-"',
+        ]
+    ),
+    (
+        '{"time_local": "$time_local","browser": [{"modern_browser": "$modern_browser",'
+        '"ancient_browser": "$ancient_browser","msie": "$msie"}],"core": [{"args": "$args","uri": "$uri"}]}',
+        [
+            '{"time_local": "27/Jan/2016:12:30:04 -0800","browser": [{"modern_browser": "-","ancient_browser": "1",'
+            '"msie": "-"}],"core": [{"args": "-","uri": "/status"}]}',
+        ]
+    ),
+)
+
+
 class LogParserTestCase(BaseTestCase):
     def test_prepare_combined(self):
         """
@@ -28,7 +188,7 @@ class LogParserTestCase(BaseTestCase):
             assert_that(parser.keys, has_item(key))
 
         assert_that(parser.regex_string, equal_to(
-            r'(?P<remote_addr>.+)\ \-\ (?P<remote_user>.+)\ \[(?P<time_local>.+)\]\ \"(?P<request>.+)\"\ (?P<status>\d+)\ (?P<body_bytes_sent>\d+)\ \"(?P<http_referer>.+)\"\ \"(?P<http_user_agent>.+)\"'))
+            r'^(?P<remote_addr>[^\ ]*)\ \-\ (?P<remote_user>.+?)\ \[(?P<time_local>[^\]]*)\]\ \"(?P<request>[^\"]*)\"\ (?P<status>\d+)\ (?P<body_bytes_sent>\d+)\ \"(?P<http_referer>[^\"]*)\"\ \"(?P<http_user_agent>.+)\"$'))
 
     def test_parse_combined(self):
         """
@@ -286,3 +446,348 @@ class LogParserTestCase(BaseTestCase):
 
         for key in expected_keys:
             assert_that(parsed, has_item(key))
+
+
+class DelimiterAwareRegexTestCase(BaseTestCase):
+    def test_bounded_variables(self):
+        user_format = '$remote_addr [$time_local] "$request" $status $http_x_forwarded_for "$http_user_agent"'
+        parser = NginxAccessLogParser(user_format)
+
+        assert_that(parser.regex_string, equal_to(
+            r'^(?P<remote_addr>[^\ ]*)\ \[(?P<time_local>[^\]]*)\]\ \"(?P<request>[^\"]*)\"\ (?P<status>\d+)\ ' +
+            r'(?P<http_x_forwarded_for>.+?)\ \"(?P<http_user_agent>.+)\"$'
+        ))
+
+    def test_same_results(self):
+        for log_format, lines in sample_logs:
+            parser = NginxAccessLogParser(log_format)
+            baseline_parser = BaselineNginxAccessLogParser(log_format)
+            for line in lines:
+                assert_that(parser.parse(line), equal_to(baseline_parser.parse(line)))
+
+    def test_user_with_spaces(self):
+        line = '1.2.3.4 - John Smith [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 "-" "curl"'
+        parsed = NginxAccessLogParser().parse(line)
+
+        assert_that(parsed['remote_user'], equal_to('John Smith'))
+        assert_that(parsed['status'], equal_to('200'))
+
+    def test_empty_time(self):
+        parser = NginxAccessLogParser('$status "$request" $request_time $upstream_response_time')
+        line = '200 "GET / HTTP/1.1"  0.010'
+
+        parsed = parser.parse(line)
+        assert_that(parsed, equal_to({
+            'malformed': False, 'status': '200', 'request': 'GET / HTTP/1.1',
+            'http_method': 'GET', 'request_uri': '/', 'http_version': '1.1', 'upstream_response_time': [0.01]
+        }))
+        assert_that(parser.parse_generic(line), equal_to(parsed))
+        assert_that(list(parser.parse_chunk(line)), equal_to([parsed]))
+
+
+@performance_test
+class DelimiterAwareRegexPerformanceTestCase(BaseTestCase):
+    def test_throughput(self):
+        line = \
+            '178.23.225.78 - - [18/Jun/2015:17:22:25 +0000] "GET /img/docker.png?%s HTTP/1.1" 304 0 ' % ('a=1&' * 30) + \
+            '"http://ec2-54-78-3-178.eu-west-1.compute.amazonaws.com:4000/%s" ' % ('x/' * 30) + \
+            '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_4) AppleWebKit/537.36 (KHTML, like Gecko) ' + \
+            'Chrome/43.0.2357.124 Safari/537.36"'
+
+        timings = []
+        for parser in (BaselineNginxAccessLogParser(), NginxAccessLogParser()):
+            start = time.time()
+            for _ in xrange(20000):
+                parser.parse(line)
+            timings.append(time.time() - start)
+
+        baseline_time, bounded_time = timings
+        context.default_log.info('baseline %.3fs, delimiter-aware %.3fs' % (baseline_time, bounded_time))
+        assert_that(baseline_time / bounded_time, greater_than(3))
+
+
+class GeneratedParseFunctionTestCase(BaseTestCase):
+    def test_same_results(self):
+        for log_format, lines in sample_logs:
+            parser = NginxAccessLogParser(log_format)
+            for line in lines + ['garbage']:
+                assert_that(parser.parse(line), equal_to(parser.parse_generic(line)))
+
+    def test_duplicates(self):
+        user_format = '$remote_addr - $remote_addr - $remote_user [$time_local] "$request" rt=$request_time'
+        line = '1.2.3.4 - 5.6.7.8 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" rt=0.010'
+
+        parser = NginxAccessLogParser(user_format)
+        parsed = parser.parse(line)
+
+        assert_that(parsed, equal_to(parser.parse_generic(line)))
+        assert_that(parsed['remote_addr'], equal_to('1.2.3.4'))
+        assert_that(parsed['request_time'], equal_to([0.01]))
+
+    def test_time_values(self):
+        parser = NginxAccessLogParser('$status "$request" $upstream_response_time')
+        for value in ('0.010', '2.001, 0.345', '1 2', ' 0.1', '-', '99999999999', '12345678901, 0.2'):
+            line = '200 "GET / HTTP/1.1" %s' % value
+            assert_that(parser.parse(line), equal_to(parser.parse_generic(line)))
+
+        parsed = parser.parse('200 "GET / HTTP/1.1" 0.010')
+        assert_that(parsed['upstream_response_time'], equal_to([0.01]))
+        assert_that(parsed['http_method'], equal_to('GET'))
+        assert_that(parsed['http_version'], equal_to('1.1'))
+
+
+@performance_test
+class GeneratedParseFunctionPerformanceTestCase(BaseTestCase):
+    def test_throughput(self):
+        user_format = '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ' + \
+                      '"$http_referer" "$http_user_agent" rt=$request_time ut="$upstream_response_time" ' + \
+                      'cs=$upstream_cache_status'
+        line = '1.2.3.4 - - [22/Jan/2010:19:34:21 +0300] "GET /foo/ HTTP/1.1" 200 11078 ' + \
+               '"http://www.rambler.ru/" "Mozilla/5.0 (Windows; U; Windows NT 5.1" rt=0.010 ' + \
+               'ut="2.001, 0.345" cs=MISS'
+
+        parser = NginxAccessLogParser(user_format)
+
+        timings = []
+        for parse in (parser.parse_generic, parser.parse):
+            start = time.time()
+            for _ in xrange(100000):
+                parse(line)
+            timings.append(time.time() - start)
+
+        generic_time, generated_time = timings
+        context.default_log.info('generic %.3fs, generated %.3fs' % (generic_time, generated_time))
+        assert_that(generic_time / generated_time, greater_than(1.3))
+
+
+class SplitPlanTestCase(BaseTestCase):
+    tab_format = '$remote_addr\t$time_local\t$request\t$status\t$body_bytes_sent\t$request_time\t' + \
+                 '$upstream_response_time\t$http_user_agent'
+
+    lines = [
+        '1.2.3.4\t22/Jan/2010:19:34:21 +0300\tGET /foo/ HTTP/1.1\t200\t11078\t0.010\t2.001, 0.345\tMozilla/5.0',
+        '1.2.3.4\t22/Jan/2010:19:34:21 +0300\tGET /foo/ HTTP/1.1\t200\t11078\t0.010\t-\tcurl\twith\ttabs',
+        '1.2.3.4\t22/Jan/2010:19:34:21 +0300\t/xxx?q=1 GET POST\t400\t173\t0.000\t-\t-',
+        '1.2.3.4\t22/Jan/2010:19:34:21 +0300\tGET /foo/ HTTP/1.1\t200\t-\t0.010\t-\tcurl',
+        '1.2.3.4\t22/Jan/2010:19:34:21 +0300\tGET /foo/ HTTP/1.1\t200\t11078\t0.010\t-\t',
+        '1.2.3.4\t22/Jan/2010:19:34:21 +0300\tGET /foo/ HTTP/1.1\t200',
+        'garbage',
+        '',
+    ]
+
+    def test_uniform_separator(self):
+        parser = NginxAccessLogParser('[$remote_addr $status $body_bytes_sent $host]')
+        assert_that(parser.split_plan, equal_to(('[', ' ', ']', ['bounded', 'digits', 'digits', 'any'])))
+
+        parser = NginxAccessLogParser(self.tab_format)
+        assert_that(parser.split_plan, is_not(equal_to(None)))
+
+    def test_not_suitable(self):
+        # different separators
+        assert_that(NginxAccessLogParser().split_plan, equal_to(None))
+
+        # adjacent variables
+        assert_that(NginxAccessLogParser('$remote_addr$status').split_plan, equal_to(None))
+
+        # $request may contain spaces
+        assert_that(NginxAccessLogParser('$remote_addr $request $status').split_plan, equal_to(None))
+
+    def test_same_results(self):
+        parser = NginxAccessLogParser(self.tab_format)
+        regex_parse = parser.build_parse_function(split=False)
+
+        for line in self.lines:
+            assert_that(parser.parse(line), equal_to(regex_parse(line)))
+            assert_that(parser.parse(line), equal_to(parser.parse_generic(line)))
+
+        parsed = parser.parse(self.lines[1])
+        assert_that(parsed['http_user_agent'], equal_to('curl\twith\ttabs'))
+        assert_that(parsed, is_not(has_item('upstream_response_time')))
+
+
+@performance_test
+class SplitPlanPerformanceTestCase(BaseTestCase):
+    def test_throughput(self):
+        user_format = '\t'.join([
+            '$remote_addr', '$status', '$scheme', '$host', '$request_method', '$server_port', '$remote_user',
+            '$msec', '$upstream_cache_status', '$server_protocol', '$remote_port', '$http_user_agent'
+        ])
+        parser = NginxAccessLogParser(user_format)
+        regex_parse = parser.build_parse_function(split=False)
+
+        # 2M lines synthetic log
+        lines = [
+            '10.0.%s.%s\t200\thttps\texample.com\tGET\t443\t-\t1453.1\tHIT\tHTTP/1.1\t%s\tcurl/7.%s' % (
+                i % 256, i % 100, 1024 + i, i
+            ) for i in xrange(1000)
+        ]
+
+        timings = []
+        for parse in (regex_parse, parser.parse):
+            start = time.time()
+            for _ in xrange(2000):
+                for line in lines:
+                    parse(line)
+            timings.append(time.time() - start)
+
+        regex_time, split_time = timings
+        context.default_log.info('regex %.3fs, split %.3fs' % (regex_time, split_time))
+        assert_that(regex_time, greater_than(split_time))
+
+
+class ChunkParseTestCase(BaseTestCase):
+    def test_same_results(self):
+        for log_format, lines in sample_logs + ((SplitPlanTestCase.tab_format, SplitPlanTestCase.lines),):
+            parser = NginxAccessLogParser(log_format)
+            # FileTail used to strip lines as well
+            expected = [parser.parse(line.rstrip()) for line in lines if line]
+            expected = [parsed for parsed in expected if len(parsed) > 1]
+            assert_that(list(parser.parse_chunk('\n'.join(lines) + '\n')), equal_to(expected))
+
+    def test_step(self):
+        parser = NginxAccessLogParser('$status')
+        chunk = ''.join('%s\n' % status for status in xrange(200, 220))
+
+        parsed = list(parser.parse_chunk(chunk, step=5))
+        assert_that([p['status'] for p in parsed], equal_to(['200', '205', '210', '215']))
+
+        parsed = list(parser.parse_chunk(chunk, start=3, step=5))
+        assert_that([p['status'] for p in parsed], equal_to(['203', '208', '213', '218']))
+
+    def test_bad_line(self):
+        parser = NginxAccessLogParser('$status $request_time')
+        parsed = list(parser.parse_chunk('200 0.1\ngarbage\n200 x\n\n404 0.2'))
+        assert_that(parsed, has_length(3))
+        assert_that(parsed[0]['request_time'], equal_to([0.1]))
+        assert_that(parsed[1], equal_to(None))
+        assert_that(parsed[2]['status'], equal_to('404'))
+
+
+@performance_test
+class ChunkParsePerformanceTestCase(BaseTestCase):
+    test_log = 'log/access_chunks.log'
+
+    def teardown_method(self, method):
+        if os.path.exists(self.test_log):
+            os.remove(self.test_log)
+        super(ChunkParsePerformanceTestCase, self).teardown_method(method)
+
+    def test_throughput(self):
+        parser = NginxAccessLogParser()
+        line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" ' + \
+               '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"\n'
+
+        # 1M lines synthetic log, read by lines and by chunks
+        open(self.test_log, 'w').close()
+
+        timings = []
+        for by_chunks in (False, True):
+            tail = FileTail(self.test_log)
+            with open(self.test_log, 'a') as f:
+                for _ in xrange(100):
+                    f.write(line * 10000)
+
+            start = time.time()
+            if by_chunks:
+                for chunk in tail.readchunks():
+                    for parsed in parser.parse_chunk(chunk):
+                        pass
+            else:
+                for tail_line in tail:
+                    parser.parse(tail_line)
+            timings.append(time.time() - start)
+
+        line_time, chunk_time = timings
+        context.default_log.info('per line %.3fs, chunk %.3fs' % (line_time, chunk_time))
+
+        # FileTail splits lines from blocks itself, so the gain comes from parsing a chunk at once only
+        assert_that(line_time, greater_than(chunk_time))
+
+
+class ProjectionTestCase(BaseTestCase):
+    fields = ('request', 'status', 'upstream_*')
+
+    def test_prepare_combined(self):
+        parser = NginxAccessLogParser(fields=self.fields)
+        assert_that(parser.captured_keys, equal_to(['request', 'status']))
+        assert_that(parser.regex_string, equal_to(
+            r'^(?:[^\ ]*)\ \-\ (?:.+?)\ \[(?:[^\]]*)\]\ \"(?P<request>[^\"]*)\"\ (?P<status>\d+)\ (?:\d+)\ ' +
+            r'\"(?:[^\"]*)\"\ \"(?:.+)\"$'
+        ))
+
+    def test_captures(self):
+        parser = NginxAccessLogParser(fields=self.fields)
+        assert_that(parser.captures('status'), equal_to(True))
+        assert_that(parser.captures('upstream_addr'), equal_to(True))
+        assert_that(parser.captures('http_referer'), equal_to(False))
+
+        # all variables by default
+        assert_that(NginxAccessLogParser().captures('http_referer'), equal_to(True))
+
+    def test_same_results(self):
+        for log_format, lines in sample_logs + ((SplitPlanTestCase.tab_format, SplitPlanTestCase.lines),):
+            full_parser = NginxAccessLogParser(log_format)
+            parser = NginxAccessLogParser(log_format, fields=self.fields)
+
+            for line in lines:
+                expected = full_parser.parse(line)
+                for key in expected.keys():
+                    if key in full_parser.keys and not parser.captures(key):
+                        del expected[key]
+
+                assert_that(parser.parse(line), equal_to(expected))
+                assert_that(parser.parse_generic(line), equal_to(expected))
+
+
+class ParserCacheTestCase(BaseTestCase):
+    def test_cached_by_format(self):
+        cache = NginxAccessLogParserCache()
+        parser = cache.get()
+        assert_that(cache.get(NginxAccessLogParser.combined_format), equal_to(parser))
+        assert_that(cache.get('$remote_addr $status'), is_not(equal_to(parser)))
+        assert_that(cache.get(fields=['status']), is_not(equal_to(parser)))
+        assert_that(cache.get(fields=('status', 'status')), equal_to(cache.get(fields=['status'])))
+
+        assert_that(cache.hits, equal_to(3))
+        assert_that(cache.misses, equal_to(3))
+
+    def test_lru(self):
+        cache = NginxAccessLogParserCache(size=2)
+        first = cache.get('$status')
+        second = cache.get('$status $request')
+        assert_that(cache.get('$status'), equal_to(first))
+
+        # the least recently used one is dropped
+        cache.get('$status $request_time')
+        assert_that(cache.parsers, has_length(2))
+        assert_that(cache.get('$status'), equal_to(first))
+        assert_that(cache.get('$status $request'), is_not(equal_to(second)))
+
+
+@performance_test
+class ProjectionPerformanceTestCase(BaseTestCase):
+    def test_throughput(self):
+        # wide format with 32 variables
+        names = ['remote_addr', 'remote_user', 'time_local', 'request', 'status', 'body_bytes_sent'] + \
+                ['cookie_%s' % i for i in xrange(20)] + \
+                ['http_referer', 'http_user_agent', 'request_time', 'upstream_addr', 'upstream_status']
+        log_format = ' '.join('"$%s"' % name for name in names) + ' "$upstream_response_time"'
+        line = ' '.join('"%s"' % value for value in (
+            ['10.0.0.1', '-', '02/Jul/2015:14:49:48 +0000', 'GET /foo/ HTTP/1.1', '200', '110'] +
+            ['cookie value %s' % i for i in xrange(20)] +
+            ['-', 'Mozilla/5.0 (Windows NT 6.1)', '0.010', '10.0.0.2:80', '200', '0.009']
+        ))
+
+        full_parser = NginxAccessLogParser(log_format)
+        parser = NginxAccessLogParser(log_format, fields=NginxAccessLogsCollector.parsed_variables)
+
+        timings = []
+        for parse in (full_parser.parse, parser.parse):
+            start = time.time()
+            for _ in xrange(200000):
+                parse(line)
+            timings.append(time.time() - start)
+
+        full_time, projected_time = timings
+        context.default_log.info('all variables %.3fs, projected %.3fs' % (full_time, projected_time))
+        assert_that(full_time, greater_than(projected_time * 1.1))
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
+import re
+import time
+
 from hamcrest import *
 
-from test.base import BaseTestCase
-from amplify.agent.containers.nginx.log.error import NginxErrorLogParser
+from test.base import BaseTestCase, performance_test
+from amplify.agent.context import context
+from amplify.agent.containers.nginx.log.error import NginxErrorLogParser, ErrorTemplates, error_re, error_keywords, \
+    upstream_address, mask_message
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -12,6 +17,42 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+def legacy_parse(line):
+    """
+    Tries every regex one by one, the way the parser did before they were combined
+    """
+    for error, regexps in error_re.iteritems():
+        for regexp in regexps:
+            if re.match(regexp, line):
+                return error
+    return None
+
+
+sample_lines = [
+    '2015/07/14 08:42:57 [error] 28386#28386: *38698 upstream timed out (110: Connection timed out) while reading '
+    'response header from upstream, client: 127.0.0.1, server: localhost, request: "GET /1.0/ HTTP/1.0", '
+    'upstream: "uwsgi://127.0.0.1:3131", host: "localhost:5000"',
+    '2015/07/14 08:42:57 [error] 28386#28386: *38699 connect() failed (111: Connection refused) while connecting '
+    'to upstream, client: 127.0.0.1, server: localhost, request: "GET / HTTP/1.1", upstream: "http://127.0.0.1:80/"',
+    '2015/07/14 08:42:57 [error] 28386#28386: *38700 no live upstreams while connecting to upstream, '
+    'client: 127.0.0.1, server: localhost, request: "GET / HTTP/1.1", upstream: "http://backend/"',
+    '2015/07/14 08:42:57 [error] 28386#28386: *38701 upstream sent invalid header while reading response header '
+    'from upstream, client: 127.0.0.1, server: localhost, request: "GET / HTTP/1.1"',
+    '2015/07/14 08:42:57 [error] 28386#28386: *38702 upstream prematurely closed connection while reading response '
+    'header from upstream, client: 127.0.0.1, server: localhost, request: "GET / HTTP/1.1"',
+    '2015/07/14 08:42:57 [warn] 28386#28386: *38703 a client request body is buffered to a temporary file '
+    '/var/cache/nginx/client_temp/0000000001, client: 127.0.0.1, server: localhost, request: "POST / HTTP/1.1"',
+    '2015/07/14 08:42:57 [error] 28386#28386: *38704 recv() failed (104: Connection reset by peer) while reading '
+    'upstream, client: 127.0.0.1, server: localhost, request: "GET / HTTP/1.1"',
+    '2015/07/14 08:42:57 [error] 28386#28386: *38705 open() "/usr/share/nginx/html/favicon.ico" failed '
+    '(2: No such file or directory), client: 127.0.0.1, server: localhost, request: "GET /favicon.ico HTTP/1.1"',
+    '2015/07/14 08:42:57 [info] 28386#28386: *38706 client 10.196.158.41 closed keepalive connection',
+    '2015/07/14 08:42:57 [notice] 28386#28386: signal process started',
+    'garbage',
+    '',
+]
+
+
 class LogParserTestCase(BaseTestCase):
     def test_upstream_response_timed_out(self):
         line = '2015/07/14 08:42:57 [error] 28386#28386: *38698 upstream timed out ' + \
@@ -41,3 +82,151 @@ class LogParserTestCase(BaseTestCase):
         parser = NginxErrorLogParser()
         parsed = parser.parse(line)
         assert_that(parsed, equal_to(None))
+
+    def test_same_results(self):
+        parser = NginxErrorLogParser()
+        for line in sample_lines:
+            assert_that(parser.parse(line), equal_to(legacy_parse(line)))
+
+    def test_keywords(self):
+        # a regex without any of keywords would never be tried
+        for regexps in error_re.itervalues():
+            for regexp in regexps:
+                assert_that(any(keyword in regexp.pattern for keyword in error_keywords), equal_to(True))
+
+
+    def test_parse_fields(self):
+        parser = NginxErrorLogParser()
+        fields = parser.parse_fields(
+            '2015/07/14 08:42:57 [error] 28386#28390: *38698 upstream timed out (110: Connection timed out) '
+            'while reading response header from upstream, client: 127.0.0.1, server: localhost, '
+            'request: "GET /1.0/?a=1, 2 HTTP/1.0", upstream: "uwsgi://127.0.0.1:3131/1.0/", host: "localhost:5000"'
+        )
+        assert_that(fields, equal_to({
+            'level': 'error',
+            'pid': 28386,
+            'tid': 28390,
+            'connection_id': 38698,
+            'message': 'upstream timed out (110: Connection timed out) while reading response header from upstream',
+            'client': '127.0.0.1',
+            'server': 'localhost',
+            'request': 'GET /1.0/?a=1, 2 HTTP/1.0',
+            'upstream': 'uwsgi://127.0.0.1:3131/1.0/',
+            'host': 'localhost:5000'
+        }))
+
+    def test_parse_fields_no_context(self):
+        parser = NginxErrorLogParser()
+        fields = parser.parse_fields('2015/07/15 05:56:30 [notice] 28386#28386: signal process started')
+        assert_that(fields, equal_to({
+            'level': 'notice',
+            'pid': 28386,
+            'tid': 28386,
+            'connection_id': None,
+            'message': 'signal process started'
+        }))
+
+        assert_that(parser.parse_fields('garbage'), equal_to(None))
+        assert_that(parser.parse_fields('2015/07/15 05:56:30 [notice] garbage'), equal_to(None))
+
+    def test_upstream_address(self):
+        assert_that(upstream_address('http://127.0.0.1:3000/api/metrics/'), equal_to('http://127.0.0.1:3000'))
+        assert_that(upstream_address('uwsgi://127.0.0.1:3131'), equal_to('uwsgi://127.0.0.1:3131'))
+        assert_that(upstream_address('127.0.0.1:3131'), equal_to('127.0.0.1:3131'))
+
+
+
+class ErrorTemplatesTestCase(BaseTestCase):
+    def test_mask_message(self):
+        for message, template in (
+            ('open() "/usr/share/nginx/html/favicon.ico" failed (2: No such file or directory)',
+             'open() "<path>" failed (<number>: No such file or directory)'),
+            ('client 10.196.158.41:5555 closed keepalive connection', 'client <ip> closed keepalive connection'),
+            ('limiting requests, excess: 20.520 by zone "one"', 'limiting requests, excess: <number> by zone "one"'),
+            ('SSL_do_handshake() failed (SSL: error:1408F10B:SSL routines)',
+             'SSL_do_handshake() failed (SSL: error:<hex>:SSL routines)'),
+            ('worker process 1234 exited on signal 9', 'worker process <number> exited on signal <number>'),
+        ):
+            assert_that(mask_message(message), equal_to(template))
+
+    def test_flush(self):
+        templates = ErrorTemplates()
+        for pid in (1, 2, 3):
+            templates.add('alert', 'worker process %s exited on signal 9' % pid)
+        templates.add('info', 'client 10.0.0.1 closed keepalive connection')
+
+        assert_that(templates.flush(top=1), equal_to([
+            ('worker process <number> exited on signal <number>', 'alert', 3)
+        ]))
+        assert_that(templates.flush(), equal_to([]))
+
+    def test_least_frequent_evicted(self):
+        templates = ErrorTemplates(max_templates=2)
+        templates.add('error', 'first')
+        templates.add('error', 'first')
+        templates.add('error', 'second')
+        templates.add('error', 'third')
+
+        assert_that(templates.templates, has_length(2))
+        assert_that(templates.flush(), equal_to([('first', 'error', 2), ('third', 'error', 1)]))
+
+    def test_evicted_after_flush(self):
+        templates = ErrorTemplates(max_templates=2)
+        for _ in xrange(4):
+            templates.add('error', 'old')
+        templates.add('error', 'recent')
+        templates.flush()
+
+        # "old" stopped appearing, its count is halved on every flush until "recent" outnumbers it
+        templates.flush()
+        for _ in xrange(3):
+            templates.add('error', 'recent')
+        templates.add('error', 'new')
+        assert_that(sorted(templates.templates), equal_to(['new', 'recent']))
+
+
+@performance_test
+class LogParserPerformanceTestCase(BaseTestCase):
+    def test_throughput(self):
+        # most lines of a real error log are not about upstreams
+        lines = sample_lines[:7] + sample_lines[7:] * 10
+        parser = NginxErrorLogParser()
+
+        timings = []
+        for parse in (legacy_parse, parser.parse):
+            start = time.time()
+            for _ in xrange(5000):
+                for line in lines:
+                    parse(line)
+            timings.append(time.time() - start)
+
+        legacy_time, combined_time = timings
+        context.default_log.info('legacy %.3fs, combined %.3fs' % (legacy_time, combined_time))
+        assert_that(legacy_time / combined_time, greater_than(3))
+
+
+@performance_test
+class ErrorTemplatesPerformanceTestCase(BaseTestCase):
+    def test_unique_flood(self):
+        class ScanningErrorTemplates(ErrorTemplates):
+            """
+            Evicts with a scan of all templates, like before the heap
+            """
+            def _evict(self):
+                least_frequent = min(self.templates.iteritems(), key=lambda item: item[1][1])[0]
+                del self.templates[least_frequent]
+
+        # every message is a new template (letters g-p are not masked as hex), so every one evicts
+        messages = ['upstream %s failed' % ''.join(chr(103 + int(d)) for d in str(i)) for i in xrange(20000)]
+
+        timings = []
+        for templates in (ScanningErrorTemplates(max_templates=1000), ErrorTemplates(max_templates=1000)):
+            start = time.time()
+            for message in messages:
+                templates.add('error', message)
+            timings.append(time.time() - start)
+            assert_that(templates.templates, has_length(1000))
+
+        scan_time, heap_time = timings
+        context.default_log.info('scan %.3fs, heap %.3fs' % (scan_time, heap_time))
+        assert_that(scan_time / heap_time, greater_than(5))
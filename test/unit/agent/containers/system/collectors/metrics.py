@@ -7,6 +7,7 @@ from hamcrest import *
 from test.base import BaseTestCase
 from amplify.agent.containers.system.container import SystemContainer
 from amplify.agent.containers.system.collectors.metrics import SystemMetricsCollector
+from amplify.agent.containers.nginx.collectors.accesslog import log_stats
 
 
 __author__ = "Mike Belov"
@@ -17,6 +18,10 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+class FakeLogCollector(object):
+    pass
+
+
 class MetricsParsersTestCase(BaseTestCase):
 
     def test_collect_only_alive_interfaces(self):
@@ -66,3 +71,31 @@ class MetricsParsersTestCase(BaseTestCase):
             for key in flush['metrics'][type].keys():
                 # Make sure there is only one item per item in the flush.
                 assert_that(len(flush['metrics'][type][key]), equal_to(1))
+
+    def test_agent(self):
+        container = SystemContainer()
+        container.discover_objects()
+
+        os_obj = container.objects.values().pop()
+        collector = SystemMetricsCollector(object=os_obj)
+
+        # two collectors read the same file during reload
+        log_collectors = [FakeLogCollector() for _ in xrange(2)]
+        log_stats[log_collectors[0]] = ('/var/log/nginx/access.log', 100, 5.0, 10)
+        log_stats[log_collectors[1]] = ('/var/log/nginx/access.log', 50, 3.0, 0)
+        collector.agent()
+
+        gauges = os_obj.statsd.current['gauge']
+        for metric_name in ('amplify.agent.status',
+                            'amplify.agent.parser_cache.hits',
+                            'amplify.agent.parser_cache.misses',
+                            'amplify.agent.log.missing'):
+            assert_that(gauges, has_key(metric_name))
+
+        assert_that(gauges['amplify.agent.log.lag_bytes|/var/log/nginx/access.log'][0][1], equal_to(100))
+        assert_that(gauges['amplify.agent.log.lines_per_second|/var/log/nginx/access.log'][0][1], equal_to(8.0))
+        assert_that(gauges['amplify.agent.log.skipped_bytes|/var/log/nginx/access.log'][0][1], equal_to(10))
+
+        # skipped bytes are reported once
+        collector.agent()
+        assert_that(gauges['amplify.agent.log.skipped_bytes|/var/log/nginx/access.log'][0][1], equal_to(0))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import random
+
+from hamcrest import *
+
+from test.base import BaseTestCase
+from amplify.agent.context import context
+from amplify.agent.statsd import StatsdClient
+from amplify.agent.util.sketch import QuantileSketch
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class FakeObject(object):
+    definition = {'type': 'nginx', 'local_id': 'test'}
+
+
+class StatsdClientTestCase(BaseTestCase):
+    def test_exact_timer(self):
+        client = StatsdClient(prefix='nginx', object=FakeObject())
+        for value in xrange(100, 0, -1):
+            client.timer('request.time', value)
+        assert_that(client.current['timer']['nginx.request.time'], instance_of(list))
+
+        timers = client.flush()['metrics']['timer']
+        assert_that(client.current, equal_to({}))
+        assert_that(timers['G|nginx.request.time'][0][1], equal_to(50.5))
+        assert_that(timers['C|nginx.request.time.count'][0][1], equal_to(100))
+        assert_that(timers['G|nginx.request.time.max'][0][1], equal_to(100))
+        assert_that(timers['G|nginx.request.time.median'][0][1], equal_to(50))
+        assert_that(timers['G|nginx.request.time.pctl95'][0][1], equal_to(96))
+
+    def test_sketch_timer(self):
+        generator = random.Random(42)
+        values = [generator.expovariate(10) for _ in xrange(100000)]
+
+        client = StatsdClient(prefix='nginx', object=FakeObject())
+        client.timer('request.time', values[0])
+        for start in xrange(1, len(values), 1000):
+            client.bulk(timers=[('request.time', values[start:start + 1000])])
+
+        sketch = client.current['timer']['nginx.request.time']
+        assert_that(sketch, instance_of(QuantileSketch))
+        assert_that(len(sketch.buckets), less_than(client.sketch_threshold))
+
+        timers = client.flush()['metrics']['timer']
+        values.sort()
+        assert_that(timers['C|nginx.request.time.count'][0][1], equal_to(100000))
+        assert_that(timers['G|nginx.request.time'][0][1], close_to(sum(values) / 100000, 0.000001))
+        assert_that(timers['G|nginx.request.time.max'][0][1], equal_to(values[-1]))
+        assert_that(timers['G|nginx.request.time.median'][0][1], close_to(values[49999], values[49999] * 0.01))
+        assert_that(timers['G|nginx.request.time.pctl95'][0][1], close_to(values[-5000], values[-5000] * 0.01))
+
+
+class TimerSettingsTestCase(BaseTestCase):
+    def setup_method(self, method):
+        super(TimerSettingsTestCase, self).setup_method(method)
+        self.original_settings = dict(context.app_config['statsd'])
+        context.app_config['statsd'].update({
+            'percentiles.nginx.request.time': '50, 90, 99, 99.9',
+            'histograms': 'nginx.request.time',
+        })
+
+    def teardown_method(self, method):
+        context.app_config['statsd'].clear()
+        context.app_config['statsd'].update(self.original_settings)
+        super(TimerSettingsTestCase, self).teardown_method(method)
+
+    def check_percentiles(self, values):
+        client = StatsdClient(prefix='nginx', object=FakeObject())
+        client.bulk(timers=[('request.time', values), ('upstream.time', values)])
+        timers = client.flush()['metrics']['timer']
+
+        values = sorted(values)
+        for suffix, percentile in (('pctl50', 50), ('pctl90', 90), ('pctl99', 99), ('pctl99_9', 99.9)):
+            exact = values[len(values) - max(int(round(len(values) * (100 - percentile) / 100.0)), 1)]
+            assert_that(timers['G|nginx.request.time.%s' % suffix][0][1], close_to(exact, exact * 0.01))
+        assert_that(timers, is_not(has_key('G|nginx.request.time.pctl95')))
+
+        # default ones
+        assert_that(timers, has_key('G|nginx.upstream.time.pctl95'))
+        assert_that(timers, is_not(has_key('G|nginx.upstream.time.pctl99')))
+        return timers
+
+    def test_exact_percentiles(self):
+        generator = random.Random(1)
+        self.check_percentiles([generator.lognormvariate(-3, 1) for _ in xrange(1000)])
+
+    def test_sketch_percentiles(self):
+        generator = random.Random(2)
+        self.check_percentiles([generator.lognormvariate(-3, 1) for _ in xrange(50000)])
+
+    def test_histogram(self):
+        generator = random.Random(3)
+        values = [generator.uniform(0.0012, 0.05) for _ in xrange(20000)] + [0.0005] * 10 + [250.0] * 2
+
+        timers = self.check_percentiles(values)
+        assert_that(timers['C|nginx.request.time.bucket|0.001'][0][1], equal_to(10))
+        assert_that(timers['C|nginx.request.time.bucket|inf'][0][1], equal_to(2))
+        assert_that(timers, is_not(has_key('C|nginx.request.time.bucket|0.1')))
+        assert_that(timers, is_not(has_key('C|nginx.upstream.time.bucket|inf')))
+
+        total = sum(value[0][1] for name, value in timers.iteritems() if '.bucket|' in name)
+        assert_that(total, equal_to(len(values)))
+
+        # only values within 1% of bounds may go to neighbour buckets
+        exact = len([value for value in values if 0.01 < value <= 0.02])
+        near_bounds = len([value for value in values if abs(value - 0.01) <= 0.0001 or abs(value - 0.02) <= 0.0002])
+        assert_that(timers['C|nginx.request.time.bucket|0.02'][0][1], close_to(exact, near_bounds))
+
+    def test_bad_percentiles(self):
+        context.app_config['statsd']['percentiles.nginx.request.time'] = '50, p99, 150'
+
+        # bad values are ignored, timers are still reported
+        client = StatsdClient(prefix='nginx', object=FakeObject())
+        client.bulk(timers=[('request.time', [0.1, 0.2, 0.3])])
+        timers = client.flush()['metrics']['timer']
+        assert_that(timers, has_key('G|nginx.request.time.pctl50'))
+        assert_that(timers, has_key('G|nginx.request.time.max'))
+        assert_that(timers, is_not(has_key('G|nginx.request.time.pctl150')))
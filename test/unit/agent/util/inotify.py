@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from hamcrest import *
+
+from test.base import BaseTestCase
+from amplify.agent.util import inotify
+from amplify.agent.util.inotify import FileWatcher, shared_inotify
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class FileWatcherTestCase(BaseTestCase):
+    test_log = 'log/watched.log'
+    test_log_rotated = 'log/watched.log.rotated'
+
+    def setup_method(self, method):
+        super(FileWatcherTestCase, self).setup_method(method)
+        self.write_log('start')
+
+    def teardown_method(self, method):
+        for filename in (self.test_log, self.test_log_rotated):
+            if os.path.exists(filename):
+                os.remove(filename)
+        super(FileWatcherTestCase, self).teardown_method(method)
+
+    def write_log(self, line):
+        with open(self.test_log, 'a') as f:
+            f.write(line + '\n')
+
+    def test_modify(self):
+        watcher = FileWatcher(self.test_log)
+        assert_that(watcher.enabled, equal_to(True))
+
+        # nothing happens
+        assert_that(watcher.wait(0.1), equal_to(False))
+
+        # a burst of writes is reported once
+        for i in xrange(10):
+            self.write_log('line %s' % i)
+        assert_that(watcher.wait(0.2), equal_to(True))
+        assert_that(watcher.wait(0.1), equal_to(False))
+
+    def test_debounce(self):
+        watcher = FileWatcher(self.test_log, debounce=0.1)
+        self.write_log('line')
+
+        # a change cuts the interval short, but not before the debounce window is over
+        started = time.time()
+        assert_that(watcher.wait(2.0), equal_to(True))
+        assert_that(time.time() - started, greater_than(0.09))
+        assert_that(time.time() - started, less_than(1.0))
+
+    def test_shared(self):
+        first = FileWatcher(self.test_log, debounce=0)
+        second = FileWatcher(self.test_log, debounce=0)
+
+        # one watch of one inotify instance serves both
+        assert_that(first.file_wd, equal_to(second.file_wd))
+        self.write_log('line')
+        assert_that(first.wait(0.2), equal_to(True))
+        assert_that(second.wait(0.2), equal_to(True))
+
+        # the watch stays while somebody needs it
+        first.close()
+        assert_that(shared_inotify.watchers, has_key(second.file_wd))
+        self.write_log('one more')
+        assert_that(second.wait(0.2), equal_to(True))
+
+    def test_rotate(self):
+        watcher = FileWatcher(self.test_log, debounce=0)
+
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('from a new file')
+        assert_that(watcher.wait(0.2), equal_to(True))
+
+        # the new file is watched
+        assert_that(watcher.wait(0.1), equal_to(False))
+        self.write_log('one more')
+        assert_that(watcher.wait(0.2), equal_to(True))
+
+    def test_overflow(self):
+        watcher = FileWatcher(self.test_log)
+        shared_inotify._events = lambda: [(-1, inotify.IN_Q_OVERFLOW, '')]
+        try:
+            shared_inotify.dispatch()
+        finally:
+            del shared_inotify._events
+
+        # the file is watched again and is read just in case
+        assert_that(watcher.changed, equal_to(True))
+        assert_that(watcher.file_wd, not_none())
+        assert_that(shared_inotify.watchers, has_key(watcher.file_wd))
+
+    def test_no_inotify(self):
+        libc, inotify.libc = inotify.libc, None
+        try:
+            watcher = FileWatcher(self.test_log)
+        finally:
+            inotify.libc = libc
+
+        assert_that(watcher.enabled, equal_to(False))
+        assert_that(watcher.wait(0.1), equal_to(True))
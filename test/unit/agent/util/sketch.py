@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import random
+
+from hamcrest import *
+
+from test.base import BaseTestCase
+from amplify.agent.util.sketch import QuantileSketch, LogLinearHistogram
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class QuantileSketchTestCase(BaseTestCase):
+    def test_accuracy(self):
+        generator = random.Random(42)
+        values = [generator.expovariate(10) for _ in xrange(100000)] + [0.0] * 100
+
+        sketch = QuantileSketch(values)
+        values.sort()
+
+        assert_that(len(sketch), equal_to(len(values)))
+        assert_that(sketch.sum, close_to(sum(values), 0.001))
+        assert_that(sketch.value_at(0), equal_to(0.0))
+        assert_that(sketch.value_at(-1), equal_to(values[-1]))
+
+        for rank in (200, 1000, 50000, 90000, 95000, 99000, -2):
+            assert_that(sketch.value_at(rank), close_to(values[rank], values[rank] * sketch.accuracy))
+
+    def test_merge(self):
+        values = [i / 1000.0 for i in xrange(1, 10001)]
+        first, second = QuantileSketch(values[::2]), QuantileSketch(values[1::2])
+        first.merge(second)
+
+        whole = QuantileSketch(values)
+        assert_that(first.buckets, equal_to(whole.buckets))
+        assert_that(first.count, equal_to(whole.count))
+        assert_that(first.max, equal_to(whole.max))
+        assert_that(first.min, equal_to(whole.min))
+
+    def test_max_buckets(self):
+        sketch = QuantileSketch([10 ** (i / 10.0) for i in xrange(-60, 60)], max_buckets=50)
+        assert_that(sketch.buckets, has_length(50))
+        assert_that(sketch.count, equal_to(120))
+        assert_that(sketch.value_at(-2), close_to(10 ** 5.8, 10 ** 5.8 * sketch.accuracy))
+
+    def test_empty(self):
+        sketch = QuantileSketch()
+        sketch.extend([])
+        assert_that(len(sketch), equal_to(0))
+        assert_that(calling(sketch.value_at).with_args(0), raises(IndexError))
+
+
+class LogLinearHistogramTestCase(BaseTestCase):
+    def test_buckets(self):
+        histogram = LogLinearHistogram()
+        assert_that(histogram.bounds[:3], equal_to([0.001, 0.002, 0.003]))
+        assert_that(histogram.bounds[-2:], equal_to([90.0, 100.0]))
+
+        histogram.extend([0.0, 0.001, 0.0011, 0.0035, 0.004, 99.0, 100.5])
+        histogram.add(0.002, count=3)
+        assert_that(histogram.items(), equal_to([
+            ('0.001', 2), ('0.002', 4), ('0.004', 2), ('100', 1), ('inf', 1)
+        ]))
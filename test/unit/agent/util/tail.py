@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
+import zlib
 
 from hamcrest import *
 
 from test.base import BaseTestCase
-from amplify.agent.util.tail import FileTail
+from amplify.agent.context import context
+from amplify.agent.util.tail import FileTail, tail_checkpoints
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -63,7 +65,7 @@ class TailTestCase(BaseTestCase):
         assert_that(new_lines, has_length(1))
         assert_that(new_lines, equal_to(['from a new file']))
 
-    def test_lose_changes_while_rotate(self):
+    def test_read_old_file_after_rotate(self):
         tail = FileTail(filename=self.test_log)
 
         # write something
@@ -77,8 +79,71 @@ class TailTestCase(BaseTestCase):
 
         # read tail and get two lines
         new_lines = tail.readlines()
-        assert_that(new_lines, has_length(1))
-        assert_that(new_lines, equal_to(['from a new file']))
+        assert_that(new_lines, has_length(2))
+        assert_that(new_lines, equal_to(['from the old file', 'from a new file']))
+
+    def test_logrotate_create(self):
+        tail = FileTail(filename=self.test_log)
+
+        # nginx keeps the old file open
+        nginx_log = open(self.test_log, 'a')
+        nginx_log.write('first\n')
+        nginx_log.flush()
+        assert_that(tail.readlines(), equal_to(['first']))
+
+        # logrotate renames the log and creates a new one, nginx writes to the old one until it gets USR1
+        nginx_log.write('second\n')
+        nginx_log.flush()
+        os.rename(self.test_log, self.test_log_rotated)
+        open(self.test_log, 'w').close()
+        nginx_log.write('third\nfourth')
+        nginx_log.close()
+
+        nginx_log = open(self.test_log, 'a')
+        nginx_log.write('fifth\n')
+        nginx_log.close()
+
+        assert_that(tail.readlines(), equal_to(['second', 'third', 'fourth', 'fifth']))
+
+        self.write_log('sixth')
+        assert_that(tail.readlines(), equal_to(['sixth']))
+
+    def test_logrotate_create_readchunks(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('first')
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('second')
+
+        assert_that(list(tail.readchunks()), equal_to(['first\n', 'second\n']))
+        assert_that(tail.backlog(), equal_to(0))
+
+    def test_logrotate_copytruncate(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('a long line from the old file')
+        assert_that(tail.readlines(), equal_to(['a long line from the old file']))
+
+        # copy and truncate in place - inode stays the same
+        with open(self.test_log) as f, open(self.test_log_rotated, 'w') as rotated:
+            rotated.write(f.read())
+        open(self.test_log, 'w').close()
+        self.write_log('new')
+
+        assert_that(tail.backlog(), equal_to(4))
+        assert_that(tail.readlines(), equal_to(['new']))
+        assert_that(tail.backlog(), equal_to(0))
+
+    def test_lazy(self):
+        tail = FileTail(filename=self.test_log, lazy=True)
+        assert_that(tail._fd, equal_to(None))
+
+        self.write_log('first')
+        assert_that(tail.backlog(), equal_to(6))
+        assert_that(tail._fd, equal_to(None))
+
+        assert_that(tail.readlines(), equal_to(['first']))
+        assert_that(tail._fd, not_none())
+
+        assert_that(calling(FileTail).with_args(filename='log/nonexistent.log', lazy=True), raises(IOError))
 
     def test_no_new_lines(self):
         # check one new line
@@ -96,3 +161,321 @@ class TailTestCase(BaseTestCase):
         self.write_log('something')
         new_lines = tail.readlines()
         assert_that(new_lines, has_length(1))
+
+    def test_partial_line(self):
+        tail = FileTail(filename=self.test_log)
+        with open(self.test_log, 'a') as f:
+            f.write('complete\nincompl')
+
+        assert_that(tail.readlines(), equal_to(['complete']))
+        assert_that(tail.backlog(), equal_to(7))
+
+        with open(self.test_log, 'a') as f:
+            f.write('ete\n')
+
+        assert_that(tail.readlines(), equal_to(['incomplete']))
+        assert_that(tail.backlog(), equal_to(0))
+
+    def test_rotation_checked_once_per_pass(self):
+        class CountingFileTail(FileTail):
+            checks = 0
+
+            def _file_state(self):
+                self.checks += 1
+                return super(CountingFileTail, self)._file_state()
+
+        tail = CountingFileTail(filename=self.test_log)
+        for i in xrange(100):
+            self.write_log("this is %s line" % i)
+
+        assert_that(tail.readlines(), has_length(100))
+        assert_that(tail.checks, equal_to(1))
+
+        self.write_log('one more')
+        assert_that(tail.readlines(), equal_to(['one more']))
+        assert_that(tail.checks, equal_to(2))
+
+    def test_missing(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('before removal')
+        os.remove(self.test_log)
+
+        # the removed file is still read to its end
+        assert_that(tail.readlines(), equal_to(['before removal']))
+        assert_that(tail.missing_since, not_none())
+        assert_that(list(tail.readchunks()), has_length(0))
+
+        # checks are delayed more and more
+        delays = []
+        for _ in xrange(8):
+            tail._next_check = 0
+            tail.readlines()
+            delays.append(tail._missing_delay)
+        assert_that(delays, equal_to([2.0, 4.0, 8.0, 16.0, 32.0, 60.0, 60.0, 60.0]))
+
+        # nginx created it again
+        self.write_log('new file')
+        tail._next_check = 0
+        assert_that(tail.readlines(), equal_to(['new file']))
+        assert_that(tail.missing_since, equal_to(None))
+
+    def test_readchunks(self):
+        tail = FileTail(filename=self.test_log)
+        for i in xrange(100):
+            self.write_log("this is %s line" % i)
+
+        chunks = list(tail.readchunks(size=64))
+        assert_that(len(chunks), greater_than(1))
+        for chunk in chunks:
+            assert_that(chunk[-1], equal_to('\n'))
+
+        lines = ''.join(chunks).split('\n')[:-1]
+        assert_that(lines, has_length(100))
+        assert_that(lines[-1], equal_to('this is 99 line'))
+
+        # nothing left
+        assert_that(list(tail.readchunks()), has_length(0))
+
+    def test_readchunks_partial_line(self):
+        tail = FileTail(filename=self.test_log)
+        with open(self.test_log, 'a') as f:
+            f.write('complete\nincompl')
+
+        assert_that(list(tail.readchunks()), equal_to(['complete\n']))
+
+        with open(self.test_log, 'a') as f:
+            f.write('ete\n')
+
+        assert_that(list(tail.readchunks(size=4)), equal_to(['incomplete\n']))
+
+    def test_readchunks_stop(self):
+        tail = FileTail(filename=self.test_log)
+        for line in ('12345', '23456', '34567'):
+            self.write_log(line)
+
+        chunks = tail.readchunks(size=6)
+        assert_that(next(chunks), equal_to('12345\n'))
+        chunks.close()
+        assert_that(tail.backlog(), equal_to(12))
+        assert_that(tail.caught_up, equal_to(False))
+
+        assert_that(list(tail.readchunks()), equal_to(['23456\n34567\n']))
+        assert_that(tail.backlog(), equal_to(0))
+        assert_that(tail.caught_up, equal_to(True))
+
+    def test_readchunks_truncated(self):
+        tail = FileTail(filename=self.test_log)
+        for i in xrange(100):
+            self.write_log("this is %s line" % i)
+
+        # copytruncate in the middle of a pass
+        chunks = tail.readchunks(size=64)
+        assert_that(next(chunks), equal_to('this is 0 line\nthis is 1 line\nthis is 2 line\nthis is 3 line\n'))
+        open(self.test_log, 'w').close()
+        assert_that(list(chunks), has_length(0))
+
+        # the next pass reads the new content from the beginning
+        self.write_log('new')
+        assert_that(list(tail.readchunks()), equal_to(['new\n']))
+
+    def test_skip_to_end(self):
+        tail = FileTail(filename=self.test_log)
+        self.write_log('12345')
+        self.write_log('23456')
+
+        assert_that(tail.skip_to_end(), equal_to(12))
+        assert_that(tail.backlog(), equal_to(0))
+
+        self.write_log('34567')
+        assert_that(tail.readlines(), equal_to(['34567']))
+
+    def test_backlog(self):
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.backlog(), equal_to(0))
+
+        self.write_log('12345')
+        assert_that(tail.backlog(), equal_to(6))
+
+        tail.readlines()
+        assert_that(tail.backlog(), equal_to(0))
+
+
+class GzipTailTestCase(BaseTestCase):
+    test_log = 'log/something.log.gz'
+
+    def setup_method(self, method):
+        super(GzipTailTestCase, self).setup_method(method)
+        self.write_log(self.compress('start\n'))
+
+    def teardown_method(self, method):
+        if os.path.exists(self.test_log):
+            os.remove(self.test_log)
+        super(GzipTailTestCase, self).teardown_method(method)
+
+    def write_log(self, data):
+        with open(self.test_log, 'ab') as f:
+            f.write(data)
+
+    @staticmethod
+    def compress(data):
+        """
+        :return: str one gzip member, like nginx writes on every buffer flush
+        """
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def test_members(self):
+        tail = FileTail(filename=self.test_log, gzip=True)
+        self.write_log(self.compress('first\nsecond\n'))
+        self.write_log(self.compress('third\n'))
+        assert_that(tail.readlines(), equal_to(['first', 'second', 'third']))
+
+        self.write_log(self.compress('fourth\n'))
+        assert_that(tail.readlines(), equal_to(['fourth']))
+        assert_that(tail.backlog(), equal_to(0))
+
+    def test_partial_member(self):
+        tail = FileTail(filename=self.test_log, gzip=True)
+        member = self.compress('first\n' + 'x' * 10000 + '\nlast\n')
+
+        self.write_log(member[:len(member) / 2])
+        assert_that(tail.readlines(), equal_to(['first']))
+
+        self.write_log(member[len(member) / 2:])
+        assert_that(tail.readlines(), equal_to(['x' * 10000, 'last']))
+
+    def test_partial_line_between_members(self):
+        tail = FileTail(filename=self.test_log, gzip=True)
+        self.write_log(self.compress('first\nsec'))
+        assert_that(tail.readlines(), equal_to(['first']))
+
+        self.write_log(self.compress('ond\n'))
+        assert_that(list(tail.readchunks()), equal_to(['second\n']))
+
+    def test_readchunks_after_next(self):
+        tail = FileTail(filename=self.test_log, gzip=True)
+        self.write_log(self.compress('first\nsecond\nthird\n'))
+        assert_that(tail.next(), equal_to('first'))
+        assert_that(list(tail.readchunks()), equal_to(['second\nthird\n']))
+
+    def test_start_inside_member(self):
+        member = self.compress('lost\n' * 100)
+        self.write_log(member[:20])
+        tail = FileTail(filename=self.test_log, gzip=True)
+
+        self.write_log(member[20:])
+        self.write_log(self.compress('found\n'))
+        assert_that(tail.readlines(), equal_to(['found']))
+
+
+class CheckpointsTestCase(BaseTestCase):
+    test_log = TailTestCase.test_log
+    test_log_rotated = TailTestCase.test_log_rotated
+    test_checkpoints = 'log/tails.json'
+
+    def setup_method(self, method):
+        super(CheckpointsTestCase, self).setup_method(method)
+        self.write_log('start')
+        tail_checkpoints.path = self.test_checkpoints
+        tail_checkpoints.checkpoints = None
+
+    def teardown_method(self, method):
+        tail_checkpoints.path = None
+        tail_checkpoints.checkpoints = None
+        for filename in (self.test_log, self.test_log_rotated, self.test_checkpoints):
+            if os.path.exists(filename):
+                os.remove(filename)
+        super(CheckpointsTestCase, self).teardown_method(method)
+
+    def write_log(self, line):
+        os.system('echo %s >> %s' % (line, self.test_log))
+
+    def stop_reading(self):
+        """
+        Reads one line, writes two more and saves the position like the agent does on shutdown
+        """
+        tail = FileTail(filename=self.test_log)
+        self.write_log('read')
+        assert_that(tail.readlines(), equal_to(['read']))
+        self.write_log('first')
+        self.write_log('second')
+
+        tail_checkpoints.release(tail)
+        tail_checkpoints.save(force=True)
+        tail_checkpoints.checkpoints = None  # forget everything but the state file
+
+    def test_resume(self):
+        self.stop_reading()
+
+        tail = FileTail(filename=self.test_log, resume_max_bytes=1024)
+        assert_that(tail.resume_error, equal_to(None))
+        assert_that(tail.readlines(), equal_to(['first', 'second']))
+
+    def test_no_resume(self):
+        self.stop_reading()
+
+        tail = FileTail(filename=self.test_log)
+        assert_that(tail.readlines(), has_length(0))
+
+    def test_too_much_written(self):
+        self.stop_reading()
+
+        tail = FileTail(filename=self.test_log, resume_max_bytes=10)
+        assert_that(tail.resume_error, equal_to('13 bytes were written, more than 10'))
+        assert_that(tail.readlines(), has_length(0))
+
+    def test_rotated(self):
+        self.stop_reading()
+        os.rename(self.test_log, self.test_log_rotated)
+        self.write_log('from a new file')
+
+        tail = FileTail(filename=self.test_log, resume_max_bytes=1024)
+        assert_that(tail.resume_error, equal_to('the file was rotated'))
+        assert_that(tail.readlines(), has_length(0))
+
+    def test_reload(self):
+        # the collector of the old nginx object still reads the log when the new one is created
+        old_tail = FileTail(filename=self.test_log, resume_max_bytes=1024)
+        self.write_log('first')
+        assert_that(old_tail.readlines(), equal_to(['first']))
+
+        # a stale checkpoint must not be used
+        tail_checkpoints.save(force=True)
+        self.write_log('second')
+        assert_that(old_tail.readlines(), equal_to(['second']))
+
+        tail = FileTail(filename=self.test_log, resume_max_bytes=1024)
+        assert_that(tail.resume_error, equal_to(None))
+
+        # the old object reads a bit more and stops
+        self.write_log('third')
+        assert_that(old_tail.readlines(), equal_to(['third']))
+        self.write_log('fourth')
+        tail_checkpoints.release(old_tail)
+
+        assert_that(tail.readlines(), equal_to(['fourth']))
+
+    def test_default_path(self):
+        tail_checkpoints.path = None
+        daemon_config = context.app_config['daemon']
+        pid_file, checkpoints = daemon_config['pid'], daemon_config.get('tail_checkpoints')
+        try:
+            # the init script makes the pid file directory writable for the agent user
+            daemon_config['pid'] = '/var/run/amplify-agent/amplify-agent.pid'
+            daemon_config['tail_checkpoints'] = None
+            assert_that(tail_checkpoints._path(), equal_to('/var/run/amplify-agent/amplify_agent.tails'))
+
+            daemon_config['tail_checkpoints'] = '/tmp/tails'
+            assert_that(tail_checkpoints._path(), equal_to('/tmp/tails'))
+        finally:
+            daemon_config['pid'], daemon_config['tail_checkpoints'] = pid_file, checkpoints
+
+    def test_save_failed(self):
+        tail_checkpoints.path = 'log/missing/tails.json'
+        tail_checkpoints.save(force=True)
+        assert_that(tail_checkpoints.save_failed, equal_to(True))
+
+        tail_checkpoints.path = self.test_checkpoints
+        tail_checkpoints.save(force=True)
+        assert_that(tail_checkpoints.save_failed, equal_to(False))
+        assert_that(os.path.exists(self.test_checkpoints), equal_to(True))
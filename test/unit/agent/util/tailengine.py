@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import os
+
+from hamcrest import *
+
+from test.base import NginxCollectorTestCase
+from amplify.agent.util.tail import FileTail
+from amplify.agent.util.tailengine import TailEngine
+from amplify.agent.containers.nginx.collectors.accesslog import NginxAccessLogsCollector
+
+__author__ = "Mike Belov"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__credits__ = ["Mike Belov", "Andrei Belov", "Ivan Poluyanov", "Oleg Mamontov", "Andrew Alexeev", "Grant Hulegaard"]
+__license__ = ""
+__maintainer__ = "Mike Belov"
+__email__ = "dedm@nginx.com"
+
+
+class TailEngineTestCase(NginxCollectorTestCase):
+    test_logs = ['log/engine_%s.log' % i for i in xrange(3)]
+
+    line = '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" ' + \
+           '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"\n'
+
+    def setup_method(self, method):
+        super(TailEngineTestCase, self).setup_method(method)
+        for filename in self.test_logs:
+            open(filename, 'w').close()
+        self.fake_object.running = True
+
+    def teardown_method(self, method):
+        for filename in self.test_logs:
+            if os.path.exists(filename):
+                os.remove(filename)
+        super(TailEngineTestCase, self).teardown_method(method)
+
+    def test_cycle(self):
+        engine = TailEngine(max_open_files=2)
+        collectors = [
+            NginxAccessLogsCollector(object=self.fake_object, filename=filename, interval=5, lazy_tail=True)
+            for filename in self.test_logs
+        ]
+
+        # files are opened by the engine only
+        assert_that([collector.tail._fd for collector in collectors], equal_to([None] * 3))
+        for collector in collectors:
+            engine.register(collector)
+        assert_that(engine.interval, equal_to(5))
+
+        # the second log is idle
+        for filename, lines in zip(self.test_logs, (10, 0, 20)):
+            with open(filename, 'a') as f:
+                f.write(self.line * lines)
+
+        engine.cycle()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.status.2xx'][0][1], equal_to(30))
+
+        # only the files that were read are open
+        assert_that(collectors[1].changed, equal_to(False))
+        assert_that(engine.open_tails.keys(), equal_to([collectors[2].tail, collectors[0].tail]))
+
+        # one more file to open - the least recently read one is closed
+        with open(self.test_logs[1], 'a') as f:
+            f.write(self.line * 5)
+
+        engine.cycle()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.status.2xx'][0][1], equal_to(5))
+        assert_that(engine.open_tails.keys(), equal_to([collectors[0].tail, collectors[1].tail]))
+        assert_that(collectors[2].tail._fd, equal_to(None))
+
+        # a closed file is reopened at its offset
+        with open(self.test_logs[2], 'a') as f:
+            f.write(self.line * 3)
+
+        engine.cycle()
+        counters = self.fake_object.statsd.flush()['metrics']['counter']
+        assert_that(counters['C|nginx.http.status.2xx'][0][1], equal_to(3))
+
+        for collector in collectors:
+            engine.unregister(collector)
+        assert_that(engine.collectors, has_length(0))
+        assert_that(engine.open_tails, has_length(0))
+
+    def test_order(self):
+        engine = TailEngine()
+        calls = []
+
+        class RecordingCollector(object):
+            def __init__(self, object, filename, lines):
+                self.filename = filename
+                self.object = object
+                self.interval = None
+                self.changed = True
+                self.tail = FileTail(filename)
+                with open(filename, 'a') as f:
+                    f.write(TailEngineTestCase.line * lines)
+
+            def _collect(self):
+                calls.append(self.filename)
+                self.tail.readlines()
+
+        for filename, lines in zip(self.test_logs, (1, 3, 2)):
+            engine.register(RecordingCollector(self.fake_object, filename, lines))
+
+        engine.cycle()
+        assert_that(calls, equal_to([self.test_logs[1], self.test_logs[2], self.test_logs[0]]))
+        assert_that(engine.interval, equal_to(engine.default_interval))
+
+    def test_missing(self):
+        engine = TailEngine()
+        collector = NginxAccessLogsCollector(object=self.fake_object, filename=self.test_logs[0])
+        engine.register(collector)
+
+        os.remove(self.test_logs[0])
+        engine.cycle()
+        messages = [event.message for event in self.fake_object.eventd.current.values()]
+        assert_that(messages, has_item('nginx log %s is missing' % self.test_logs[0]))
+
+        # an empty new file has no backlog, but it is found
+        open(self.test_logs[0], 'w').close()
+        collector.tail._next_check = 0
+        engine.cycle()
+        messages = [event.message for event in self.fake_object.eventd.current.values()]
+        assert_that(messages, has_item('nginx log %s is found again' % self.test_logs[0]))
+        assert_that(collector.tail.missing_since, equal_to(None))
+
+    def test_interval(self):
+        engine = TailEngine()
+        collectors = [
+            NginxAccessLogsCollector(object=self.fake_object, filename=filename, interval=interval)
+            for filename, interval in zip(self.test_logs, (5, 20))
+        ]
+        for collector in collectors:
+            engine.register(collector)
+        assert_that(engine.interval, equal_to(5))
+
+        engine.unregister(collectors[0])
+        assert_that(engine.interval, equal_to(20))
+
+        engine.unregister(collectors[1])
+        assert_that(engine.interval, equal_to(engine.default_interval))